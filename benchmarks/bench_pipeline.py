@@ -0,0 +1,183 @@
+import os
+import sys
+import argparse
+import subprocess
+import tempfile
+import shutil
+import json
+import time
+import numpy as np
+import pandas as pd
+
+##############################################################################
+# pipeline benchmark: synthetic idxstats at scale, per-stage time + peak RSS #
+##############################################################################
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+RPKM_HEATER = os.path.join(HERE, os.pardir, "rpkm_heater.py")
+TEST_DIR = os.path.join(HERE, os.pardir, "test")
+# the equivalence run only needs the RPKM table, keep its heatmap cheap #
+CHECK_MAP_ARGS = ['-dpi', '50', '-xticks', 'off', '-yticks', 'off']
+
+def parse_size(size):
+	# "genomes x samples", e.g. 100000x5000 #
+	try:
+		genomes, samples = (int(part) for part in size.lower().split("x"))
+	except ValueError:
+		raise argparse.ArgumentTypeError("size must be <genomes>x<samples>, e.g. 10000x500")
+	return genomes, samples
+
+def write_synthetic(out_dir, genomes, samples, density, seed=0):
+	# one <sample>.bam.stats per sample in samtools idxstats layout (incl. the "*" line) #
+	# a genome is recruited in a sample with probability density, reads ~ Poisson(kb x lognormal abundance) #
+	# the set is keyed by its parameters in synthetic.json and reused when they match #
+	params = {'genomes': genomes, 'samples': samples, 'density': density, 'seed': seed}
+	stamp = os.path.join(out_dir, "synthetic.json")
+	if os.path.isfile(stamp):
+		with open(stamp) as fh:
+			if json.load(fh) == params:
+				return out_dir
+	shutil.rmtree(out_dir, ignore_errors=True)
+	os.makedirs(out_dir)
+	rng = np.random.default_rng(seed)
+	lengths = rng.integers(200000, 5000000, genomes)
+	prefixes = ["G%07d\t%d\t" % (genome, length) for genome, length in enumerate(lengths)]
+	for sample in range(samples):
+		rng = np.random.default_rng([seed, sample])
+		hit = np.flatnonzero(rng.random(genomes) < density)
+		mapped = np.zeros(genomes, dtype=np.int64)
+		mapped[hit] = rng.poisson(lengths[hit] / 1000 * rng.lognormal(0, 1.5, len(hit)))
+		unmapped = int(rng.integers(0, max(int(mapped.sum()), 1)))
+		with open(os.path.join(out_dir, "S%05d.bam.stats" % sample), "w") as fh:
+			fh.write("".join([prefix + str(reads) + "\t0\n" for prefix, reads in zip(prefixes, mapped.tolist())]))
+			fh.write("*\t0\t0\t%d\n" % unmapped)
+	with open(stamp, "w") as fh:
+		json.dump(params, fh)
+	return out_dir
+
+def run_heater(script, argv):
+	# one rpkm_heater run in a child process: wall time + the child's own peak RSS (wait4) #
+	start = time.perf_counter()
+	proc = subprocess.Popen([sys.executable, script] + argv, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+	err = proc.stderr.read()
+	pid, status, usage = os.wait4(proc.pid, 0)
+	proc.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+	wall = time.perf_counter() - start
+	peak_mb = usage.ru_maxrss / 1024 if sys.platform != "darwin" else usage.ru_maxrss / 1048576
+	return {'returncode': proc.returncode, 'wall_s': round(wall, 4), 'peak_rss_mb': round(peak_mb, 1),
+		'stderr': err.decode(errors="replace").strip().splitlines()[-3:]}
+
+def time_case(script, mode, input_dir, out_dir, repeat, jobs, extra):
+	# -count/-map with -profile: per-stage wall/CPU/peak RSS from <project>_profile.json, best of repeat by wall time #
+	argv = [mode, '-i', input_dir, '-o', out_dir, '-project', 'bench', '-no_cache', '-jobs', str(jobs), '-profile'] + extra
+	runs = []
+	for run in range(repeat):
+		shutil.rmtree(out_dir, ignore_errors=True)
+		result = run_heater(script, argv)
+		profile = os.path.join(out_dir, "bench_profile.json")
+		if os.path.isfile(profile):
+			with open(profile) as fh:
+				report = json.load(fh)
+			result['stages'] = report['stages']
+			result['matrix'] = report.get('matrix')
+		runs.append(result)
+	best = min(runs, key=lambda result: result['wall_s'])
+	return dict(best, argv=[mode] + extra, walls_s=[result['wall_s'] for result in runs])
+
+def reference_rpkm(input_dir):
+	# independent RPKM of an idxstats directory: reads / (kb x million mapped reads of the sample), #
+	# log10 with values below 1 RPKM floored to 0 as in the -map table of every version #
+	columns = {}
+	for stats in sorted(os.listdir(input_dir)):
+		if not stats.endswith(".stats"):
+			continue
+		df = pd.read_csv(os.path.join(input_dir, stats), sep="\t", header=None, names=['ACC', 'length', 'mapped', 'unmapped'], dtype={'ACC': str})
+		df = df[df['ACC'] != '*'].set_index('ACC')
+		columns[stats.split(".")[0]] = df['mapped'].astype(float) / (df['length'] / 1e3) / (df['mapped'].sum() / 1e6)
+	return np.log10(pd.DataFrame(columns).clip(lower=1))
+
+def check_equivalence(script, input_dir, out_dir, baseline=None, rtol=1e-12):
+	# log10 <project>_rpkm.csv of -map on test/ against the independent formula (and an older rpkm_heater.py when given) #
+	report = {'input': os.path.abspath(input_dir), 'rtol': rtol}
+	shutil.rmtree(out_dir, ignore_errors=True)
+	result = run_heater(script, ['-map', '-i', input_dir, '-o', out_dir, '-project', 'check', '-no_cache'] + CHECK_MAP_ARGS)
+	if result['returncode'] != 0:
+		return dict(report, ok=False, error=result['stderr'])
+	current = pd.read_csv(os.path.join(out_dir, "check_rpkm.csv"), sep="\t", index_col=0, dtype={0: str})
+	current.index = current.index.astype(str)
+	expected = {'formula': reference_rpkm(input_dir)}
+	if baseline:
+		base_dir = out_dir + "_baseline"
+		shutil.rmtree(base_dir, ignore_errors=True)
+		run_heater(baseline, ['-map', '-i', input_dir, '-o', base_dir, '-project', 'check', '-no_cache'] + CHECK_MAP_ARGS)
+		base_csv = os.path.join(base_dir, "check_rpkm.csv")
+		if os.path.isfile(base_csv):
+			expected['baseline'] = pd.read_csv(base_csv, sep="\t", index_col=0, dtype={0: str})
+			expected['baseline'].index = expected['baseline'].index.astype(str)
+		else:
+			report['baseline'] = {'ok': False, 'error': "no check_rpkm.csv from " + baseline}
+	ok = True
+	for name, frame in expected.items():
+		same_labels = set(frame.index) == set(current.index) and set(frame.columns) == set(current.columns)
+		if not same_labels:
+			report[name] = {'ok': False, 'error': "genome/sample labels differ"}
+			ok = False
+			continue
+		got = current.loc[frame.index, frame.columns].values
+		want = frame.values
+		with np.errstate(divide='ignore', invalid='ignore'):
+			rel = np.abs(got - want) / np.maximum(np.abs(want), np.finfo(float).tiny)
+		rel = np.nan_to_num(rel, nan=0.0)
+		report[name] = {'ok': bool(np.allclose(got, want, rtol=rtol, atol=0, equal_nan=True)), 'max_rel_err': float(rel.max()) if rel.size else 0.0,
+			'shape': list(frame.shape)}
+		ok = ok and report[name]['ok']
+	return dict(report, ok=ok)
+
+def main():
+	parser = argparse.ArgumentParser(prog='bench_pipeline', description="Time the -count/-map stages of rpkm_heater on synthetic idxstats sets")
+	parser.add_argument('-size', type=parse_size, action="append", help="genomes x samples of a synthetic set, repeatable (default: 1000x100 and 10000x500; up to 100000x5000)")
+	parser.add_argument('-density', type=float, default=0.1, help="fraction of genomes recruited per sample (default:0.1)")
+	parser.add_argument('-seed', type=int, default=0, help="generator seed (default:0)")
+	parser.add_argument('-modes', default="count,map", help="comma separated sub-commands to time (default:count,map)")
+	parser.add_argument('-repeat', type=int, default=1, help="runs per case, the fastest is reported (default:1)")
+	parser.add_argument('-jobs', type=int, default=1, help="rpkm_heater -jobs (default:1)")
+	parser.add_argument('-map_args', default="-dpi 100 -xticks off -yticks off", help="extra -map arguments (default: '-dpi 100 -xticks off -yticks off')")
+	parser.add_argument('-script', default=RPKM_HEATER, help="rpkm_heater.py to benchmark, needs -profile (default: this checkout)")
+	parser.add_argument('-baseline', help="older rpkm_heater.py whose test/ RPKM must match (optional)")
+	parser.add_argument('-data', help="keep/reuse the synthetic sets here (default: a temporary directory)")
+	parser.add_argument('-json', help="write the report here (default: stdout)")
+	args = parser.parse_args()
+
+	sizes = args.size or [(1000, 100), (10000, 500)]
+	modes = [mode.strip().lstrip('-') for mode in args.modes.split(",") if mode.strip()]
+	work = tempfile.mkdtemp(prefix="bench_pipeline_")
+	data_root = args.data or os.path.join(work, "data")
+	try:
+		report = {'script': os.path.abspath(args.script), 'python': sys.version.split()[0], 'numpy': np.__version__, 'pandas': pd.__version__,
+			'cpu_count': os.cpu_count(), 'density': args.density, 'seed': args.seed, 'repeat': args.repeat, 'jobs': args.jobs}
+		report['equivalence'] = check_equivalence(args.script, TEST_DIR, os.path.join(work, "check"), args.baseline)
+		print("%-22s %s" % ("test/ equivalence", "ok" if report['equivalence']['ok'] else "FAILED"), file=sys.stderr)
+		report['cases'] = {}
+		for genomes, samples in sizes:
+			name = "%dx%d" % (genomes, samples)
+			start = time.perf_counter()
+			input_dir = write_synthetic(os.path.join(data_root, name + "_d%g_s%d" % (args.density, args.seed)), genomes, samples, args.density, args.seed)
+			report['cases'][name] = {'genomes': genomes, 'samples': samples, 'generate_s': round(time.perf_counter() - start, 4)}
+			for mode in modes:
+				extra = args.map_args.split() if mode == 'map' else []
+				case = time_case(args.script, '-' + mode, input_dir, os.path.join(work, "out"), args.repeat, args.jobs, extra)
+				report['cases'][name][mode] = case
+				stages = " ".join("%s=%.2fs" % (stage, record['wall_s']) for stage, record in case.get('stages', {}).items())
+				print("%-22s %8.2fs %8.0fMB  %s" % (name + " -" + mode, case['wall_s'], case['peak_rss_mb'], stages or case['stderr']), file=sys.stderr)
+	finally:
+		shutil.rmtree(work, ignore_errors=True)
+	if args.json:
+		with open(args.json, "w") as fh:
+			json.dump(report, fh, indent=1)
+	else:
+		print(json.dumps(report, indent=1))
+	if not report['equivalence']['ok']:
+		sys.exit("test/ RPKM differs from the reference, see 'equivalence' in the report")
+
+if __name__ == '__main__':
+	main()
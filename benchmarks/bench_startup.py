@@ -0,0 +1,76 @@
+import os
+import sys
+import argparse
+import subprocess
+import tempfile
+import json
+import time
+import statistics
+import textwrap
+
+#########################################################
+# startup benchmark: wall time + heavy imports per mode #
+#########################################################
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+RPKM_HEATER = os.path.join(HERE, os.pardir, "rpkm_heater.py")
+TEST_DIR = os.path.join(HERE, os.pardir, "test")
+
+# run main() in-process and report which heavy modules the sub-command pulled in #
+PROBE = textwrap.dedent('''\
+	import sys, json, runpy
+	sys.argv = [%r] + %r
+	try:
+		runpy.run_path(%r, run_name='__main__')
+	except SystemExit:
+		pass
+	sys.stderr.write(json.dumps([m for m in ('matplotlib', 'pandas', 'numpy', 'sklearn', 'scipy') if m in sys.modules]))
+	''')
+
+def scenarios(out_dir, input_dir, with_map):
+	cases = {
+		'import': None,
+		'help': ['-h'],
+		'sort_format': ['-sort_format'],
+		'phy_col_format': ['-phy_col_format'],
+		'count': ['-count', '-i', input_dir, '-o', out_dir, '-project', 'bench', '-no_cache'],
+		'count_cached': ['-count', '-i', input_dir, '-o', out_dir, '-project', 'bench'],
+	}
+	if with_map:
+		cases['map'] = ['-map', '-i', input_dir, '-o', out_dir, '-project', 'bench']
+	return cases
+
+def time_case(argv, repeat):
+	if argv is None:
+		code = "import sys, json; sys.path.insert(0, %r); import rpkm_heater; sys.stderr.write(json.dumps([m for m in ('matplotlib', 'pandas', 'numpy', 'sklearn', 'scipy') if m in sys.modules]))" % os.path.dirname(RPKM_HEATER)
+	else:
+		code = PROBE % (RPKM_HEATER, argv, RPKM_HEATER)
+	walls = []
+	for run in range(repeat):
+		start = time.perf_counter()
+		proc = subprocess.run([sys.executable, "-c", code], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+		walls.append(time.perf_counter() - start)
+	modules = json.loads(proc.stderr.strip().splitlines()[-1]) if proc.stderr.strip() else []
+	return {'argv': argv, 'returncode': proc.returncode, 'wall_min_s': min(walls), 'wall_median_s': statistics.median(walls), 'heavy_modules': modules}
+
+def main():
+	parser = argparse.ArgumentParser(prog='bench_startup', description="Time interpreter start + import + sub-command for rpkm_heater")
+	parser.add_argument('-i', default=TEST_DIR, help="idxstats directory used for -count/-map (default: test/)")
+	parser.add_argument('-repeat', type=int, default=5, help="runs per sub-command (default:5)")
+	parser.add_argument('-map', action="store_true", help="also time -map (slow: renders the heatmap)")
+	parser.add_argument('-json', help="write the report here (default: stdout)")
+	args = parser.parse_args()
+
+	with tempfile.TemporaryDirectory() as out_dir:
+		report = {'python': sys.version.split()[0], 'repeat': args.repeat, 'cases': {}}
+		for name, argv in scenarios(out_dir, args.i, args.map).items():
+			report['cases'][name] = time_case(argv, args.repeat)
+			print("%-15s %8.3fs  %s" % (name, report['cases'][name]['wall_median_s'], report['cases'][name]['heavy_modules']), file=sys.stderr)
+	if args.json:
+		with open(args.json, "w") as fh:
+			json.dump(report, fh, indent=1)
+	else:
+		print(json.dumps(report, indent=1))
+
+if __name__ == '__main__':
+	main()
@@ -3,22 +3,1399 @@ import sys
 import argparse
 import subprocess
 import shutil
-import re
 import glob
-import shlex
-import operator
-from collections import defaultdict
+import json
+import hashlib
+import contextlib
+import re
+import io
+import struct
+import gzip
+import bz2
+import zlib
+import tarfile
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import time
 import pandas as pd
 import numpy as np
-from pathlib import Path
 import textwrap
-from sklearn import preprocessing
-import matplotlib.pyplot as plt
-from matplotlib.cm import ScalarMappable
-from matplotlib.colors import ListedColormap, LinearSegmentedColormap, Normalize
-import matplotlib.patches as patches
-from mpl_toolkits.axes_grid1 import make_axes_locatable
+# matplotlib is imported inside render_heatmap so -count/help runs never pay for it #
+
+#############
+# ingestion #
+#############
+
+STATS_DTYPES = {'ACC': str, 'genome_length': np.uint32, 'reads_mapped': np.uint64, 'reads_unmapped': np.uint64}
+
+# idxstats files may be compressed, or bundled (themselves compressed or not) in tar files #
+COMPRESSED_SUFFIXES = ('.gz', '.bz2', '.zst')
+STATS_SUFFIXES = ('.stats',) + tuple('.stats'+suffix for suffix in COMPRESSED_SUFFIXES)
+BUNDLE_SUFFIXES = ('.tar', '.tgz') + tuple('.tar'+suffix for suffix in COMPRESSED_SUFFIXES)
+
+def sample_name(file_):
+	# ANE_004_05M.bam.stats[.gz/.bz2/.zst] (or an indexed ANE_004_05M.bam) --> ANE_004_05M #
+	samples = os.path.basename(file_)
+	if samples.endswith(STATS_SUFFIXES[1:]):
+		samples = os.path.splitext(samples)[0]
+	if samples.endswith(".bam"):
+		return samples[:-4]
+	samples_1 = os.path.splitext(samples)[0]
+	return os.path.splitext(samples_1)[0]
+
+def decompressed(name, fh):
+	# binary stream that inflates fh as the parser reads it, picked by the .gz/.bz2/.zst suffix of name (else fh itself) #
+	if name.endswith(('.gz', '.tgz')):
+		return gzip.GzipFile(fileobj=fh, mode='rb')
+	if name.endswith('.bz2'):
+		return bz2.BZ2File(fh)
+	if name.endswith('.zst'):
+		try:
+			import zstandard
+		except ImportError:
+			raise ValueError(name+": reading .zst files needs the zstandard package (pip install \"zstandard>=0.15\")")
+		# read_across_frames/closefd need zstandard 0.15 #
+		try:
+			return zstandard.ZstdDecompressor().stream_reader(fh, read_across_frames=True, closefd=False)
+		except TypeError:
+			raise ValueError(name+": reading .zst files needs zstandard 0.15 or later (found "+zstandard.__version__+")")
+	return fh
+
+def parse_stats(fh):
+	return pd.read_csv(fh, header=None, sep="\t", names=[*STATS_DTYPES], dtype=STATS_DTYPES, index_col='ACC')
+
+def read_stats(file_):
+	# typed parse of one idxstats file (ACC, genome_length, reads_mapped, reads_unmapped), same table for an indexed BAM #
+	if file_.endswith(".bam"):
+		return sample_name(file_), read_bam_index(file_)
+	if not file_.endswith(COMPRESSED_SUFFIXES):
+		return sample_name(file_), parse_stats(file_)
+	try:
+		with open(file_, 'rb') as raw, decompressed(file_, raw) as fh:
+			return sample_name(file_), parse_stats(fh)
+	except (OSError, EOFError) as err:
+		raise ValueError(file_+": cannot decompress ("+str(err)+")")
+
+def read_bundle(bundle):
+	# every idxstats member (compressed or not) of a tar bundle, in one streaming pass over the archive #
+	# (a member is one sample's table, held in memory while parsed since stream-mode members cannot seek) #
+	stats = []
+	try:
+		with open(bundle, 'rb') as raw, decompressed(bundle, raw) as fh, tarfile.open(fileobj=fh, mode='r|') as tar:
+			for member in tar:
+				if member.isfile() and member.name.endswith(STATS_SUFFIXES):
+					with decompressed(member.name, io.BytesIO(tar.extractfile(member).read())) as part:
+						stats.append((sample_name(member.name), parse_stats(part)))
+	except (tarfile.TarError, OSError, EOFError) as err:
+		raise ValueError(bundle+": cannot read the bundle ("+str(err)+")")
+	if not stats:
+		raise ValueError(bundle+": no .stats files in the bundle")
+	return stats
+
+def read_input(file_):
+	# one -i entry --> [(sample, stats), ...]: a tar bundle holds many samples, any other file one #
+	return read_bundle(file_) if file_.endswith(BUNDLE_SUFFIXES) else [read_stats(file_)]
+
+def input_files(directory):
+	# idxstats files (*.stats, or compressed .stats.gz/.bz2/.zst), tar bundles of them and the indexed BAMs (*.bam) #
+	# of samples without one, in path order; a sample that is there plain and compressed is read from the plain file #
+	by_sample = {}
+	for suffix in STATS_SUFFIXES:
+		for file_ in glob.glob(os.path.join(directory, "*"+suffix)):
+			by_sample.setdefault(sample_name(file_), file_)
+	bundles = [bundle for suffix in BUNDLE_SUFFIXES for bundle in glob.glob(os.path.join(directory, "*"+suffix))]
+	bams = [bam for bam in glob.glob(os.path.join(directory, "*.bam")) if sample_name(bam) not in by_sample]
+	unindexed = sorted(os.path.basename(bam) for bam in bams if bam_index(bam) is None)
+	if unindexed:
+		raise ValueError("BAMs without a .bai/.csi index (samtools index them): "+listed(unindexed))
+	files = sorted([*by_sample.values()] + bundles + bams)
+	if not files:
+		raise ValueError("no .stats/.bam inputs in "+str(directory))
+	return files
+
+def load_stats(files, jobs=1):
+	# parse idxstats files concurrently so NFS reads and decompression overlap, results kept in input order #
+	if jobs > 1:
+		with ThreadPoolExecutor(max_workers=jobs) as pool:
+			parts = [*pool.map(read_input, files)]
+	else:
+		parts = [read_input(file_) for file_ in files]
+	stats = [entry for part in parts for entry in part]
+	samples = pd.Index([sample for sample, df in stats])
+	if samples.has_duplicates:
+		raise ValueError("samples found in more than one input file: "+listed(samples[samples.duplicated()].unique().tolist()))
+	return stats
+
+def genome_length_key(stats, key=None):
+	# genome lengths are taken once (from the first file unless given); every other file has to agree #
+	if key is None:
+		first, key = stats[0][0], stats[0][1][['genome_length']]
+		stats = stats[1:]
+	else:
+		first = "the project"
+	problems = []
+	for sample, df in stats:
+		if df.index.equals(key.index) and np.array_equal(df['genome_length'].values, key['genome_length'].values):
+			continue
+		lengths = df['genome_length'].reindex(key.index)
+		missing = key.index[lengths.isna().values]
+		differ = key.index[(lengths.notna() & (lengths != key['genome_length'])).values]
+		extra = df.index.difference(key.index).drop('*', errors='ignore')
+		for label, accs in (('missing', missing), ('extra', extra), ('length differs', differ)):
+			if len(accs):
+				problems.append("%s: %d %s (%s)" % (sample, len(accs), label, ", ".join(accs[:5])))
+	if problems:
+		raise ValueError("genome lengths disagree with "+first+":\n"+"\n".join(problems))
+	return key
+
+def key_positions(key, index):
+	# row of every idxstats line in the key (-1: not in it); files written against one reference share its order #
+	return np.arange(len(key)) if index.equals(key) else key.get_indexer(index)
+
+def build_counts(gen_length_key, stats, sparse_below=0):
+	# merge the typed reads_mapped of every sample into one preallocated genomes x samples matrix (drops "*"), #
+	# or into a SparseFrame when fewer than sparse_below of the cells have reads (0: never, above 1: always) #
+	key = gen_length_key.index
+	if wants_sparse(sum(np.count_nonzero(df['reads_mapped'].values) for sample, df in stats), len(key) - int('*' in key), len(stats), sparse_below):
+		return sparse_counts(gen_length_key, stats)
+	reads = np.zeros((len(key), len(stats)), dtype=np.uint64)
+	for col, (sample, df) in enumerate(stats):
+		rows = key_positions(key, df.index)
+		hit = rows >= 0
+		reads[rows[hit], col] = df['reads_mapped'].values[hit]
+	counts = pd.DataFrame(reads, index=key, columns=[sample for sample, df in stats])
+	counts.insert(0, 'genome_length', gen_length_key['genome_length'].values)
+	return counts.drop('*', errors='ignore')
+
+#####################
+# indexed BAM input #
+#####################
+
+# samtools idxstats without samtools: the header gives the references and their lengths, the index keeps #
+# mapped/unmapped read counts per reference in a pseudo-bin, and no alignment record is ever read #
+
+BAM_HEADER_READ = 1 << 16
+BAI_PSEUDO_BIN = 37450
+BAI_BIN = struct.Struct('<Ii')
+CSI_BIN = struct.Struct('<IQi')
+INT32 = struct.Struct('<i')
+UINT32 = struct.Struct('<I')
+UINT64_PAIR = struct.Struct('<QQ')
+
+def bam_index(bam):
+	# sample.bam --> sample.bam.bai, sample.bai, sample.bam.csi or sample.csi (None: not indexed) #
+	stem = os.path.splitext(bam)[0]
+	for index in (bam+".bai", stem+".bai", bam+".csi", stem+".csi"):
+		if os.path.isfile(index):
+			return index
+	return None
+
+def read_bam_references(bam):
+	# (names, lengths) of the @SQ references from the binary BAM header, inflating only the BGZF blocks it spans #
+	with gzip.open(bam, 'rb') as fh:
+		buf = fh.read(BAM_HEADER_READ)
+		pos = 0
+		def need(size):
+			nonlocal buf
+			while len(buf) < pos + size:
+				more = fh.read(max(BAM_HEADER_READ, size))
+				if not more:
+					raise ValueError(bam+": truncated BAM header")
+				buf += more
+		need(12)
+		if buf[:4] != b'BAM\1':
+			raise ValueError(bam+": not a BAM file")
+		pos = 8 + INT32.unpack_from(buf, 4)[0]
+		need(4)
+		n_ref = INT32.unpack_from(buf, pos)[0]
+		pos += 4
+		names = []
+		lengths = []
+		unpack_int, unpack_uint = INT32.unpack_from, UINT32.unpack_from
+		for ref in range(n_ref):
+			if len(buf) < pos + 4:
+				need(4)
+			l_name = unpack_int(buf, pos)[0]
+			if len(buf) < pos + 8 + l_name:
+				need(8 + l_name)
+			names.append(buf[pos+4:pos+3+l_name].decode())
+			lengths.append(unpack_uint(buf, pos+4+l_name)[0])
+			pos += 8 + l_name
+	return names, np.array(lengths, dtype=np.uint32)
+
+def bgzf_inflate(data):
+	# BGZF (a chain of gzip members that record their own size) --> bytes, block by block without re-scanning the rest #
+	blocks = []
+	view = memoryview(data)
+	pos = 0
+	while pos < len(data):
+		if data[pos+3:pos+4] != b'\4' or data[pos+12:pos+14] != b'BC':
+			return gzip.decompress(data)
+		size = struct.unpack_from('<H', data, pos+16)[0] + 1
+		blocks.append(zlib.decompress(view[pos+18:pos+size-8], -15))
+		pos += size
+	return b''.join(blocks)
+
+def read_index_counts(index, n_ref):
+	# per-reference (mapped, unmapped) from the pseudo-bins of a .bai or (BGZF compressed) .csi, plus the unplaced reads #
+	with open(index, 'rb') as fh:
+		data = fh.read()
+	if data[:2] == b'\x1f\x8b':
+		data = bgzf_inflate(data)
+	if data[:4] == b'BAI\1':
+		csi, pseudo, pos = False, BAI_PSEUDO_BIN, 4
+		bin_head = BAI_BIN
+	elif data[:4] == b'CSI\1':
+		min_shift, depth, l_aux = struct.unpack_from('<iii', data, 4)
+		csi, pseudo, pos = True, ((1 << 3 * (depth + 1)) - 1) // 7 + 1, 16 + l_aux
+		bin_head = CSI_BIN
+	else:
+		raise ValueError(index+": not a .bai/.csi index")
+	if INT32.unpack_from(data, pos)[0] != n_ref:
+		raise ValueError(index+": indexes "+str(INT32.unpack_from(data, pos)[0])+" references, its BAM header has "+str(n_ref))
+	pos += 4
+	mapped = np.zeros(n_ref, dtype=np.uint64)
+	unmapped = np.zeros(n_ref, dtype=np.uint64)
+	unpack_int, unpack_bin, head = INT32.unpack_from, bin_head.unpack_from, bin_head.size
+	for ref in range(n_ref):
+		n_bin = unpack_int(data, pos)[0]
+		pos += 4
+		for bin_ in range(n_bin):
+			fields = unpack_bin(data, pos)
+			if fields[0] == pseudo:
+				mapped[ref], unmapped[ref] = UINT64_PAIR.unpack_from(data, pos + head + 16)
+			pos += head + 16 * fields[-1]
+		if not csi:
+			pos += 4 + 8 * unpack_int(data, pos)[0]
+	no_coor = struct.unpack_from('<Q', data, pos)[0] if len(data) >= pos + 8 else 0
+	return mapped, unmapped, no_coor
+
+def read_bam_index(bam):
+	# indexed BAM --> the read_stats() table: one row per reference plus "*" (reads without a position) #
+	index = bam_index(bam)
+	if index is None:
+		raise ValueError(bam+": no .bai/.csi index (samtools index it)")
+	names, lengths = read_bam_references(bam)
+	try:
+		mapped, unmapped, no_coor = read_index_counts(index, len(names))
+	except struct.error:
+		raise ValueError(index+": truncated index")
+	return pd.DataFrame({'genome_length': np.append(lengths, np.uint32(0)), 'reads_mapped': np.append(mapped, np.uint64(0)),
+		'reads_unmapped': np.append(unmapped, np.uint64(no_coor))}, index=pd.Index(names + ['*'], name='ACC'))
+
+##################
+# sparse backend #
+##################
+
+# projects with fewer non-zero genome x sample cells than this keep counts/RPKM as scipy.sparse matrices #
+SPARSE_DENSITY = 0.1
+
+class SparseFrame(object):
+	# labelled scipy.sparse (CSC) genomes x samples matrix, the stand-in for the counts/RPKM frames of sparse projects #
+	# counts carry their genome lengths along (the first column of a dense counts frame) #
+	def __init__(self, values, index, columns, genome_length=None):
+		self.values = values.tocsc()
+		self.index = index
+		self.columns = columns
+		self.genome_length = genome_length
+
+	@property
+	def shape(self):
+		return self.values.shape
+
+	@property
+	def dtype(self):
+		return self.values.dtype
+
+	@property
+	def T(self):
+		return SparseFrame(self.values.T, self.columns, self.index)
+
+	def density(self):
+		return self.values.nnz / max(1, self.shape[0] * self.shape[1])
+
+	def to_dense(self):
+		df = pd.DataFrame(self.values.toarray(), index=self.index, columns=self.columns)
+		if self.genome_length is not None:
+			df.insert(0, 'genome_length', self.genome_length)
+		return df
+
+	def to_csv(self, path, sep="\t", block=4096):
+		# same text as the dense frame would write, densified a block of rows at a time #
+		rows = self.values.tocsr()
+		for start in range(0, max(1, self.shape[0]), block):
+			part = SparseFrame(rows[start:start+block], self.index[start:start+block], self.columns,
+				None if self.genome_length is None else self.genome_length[start:start+block])
+			part.to_dense().to_csv(path, sep=sep, mode='w' if start == 0 else 'a', header=start == 0)
+
+	def __repr__(self):
+		return "SparseFrame: %d genomes x %d samples, %d non-zero cells (%.2f%%)" % (self.shape + (self.values.nnz, 100 * self.density()))
+
+def is_sparse(values):
+	return hasattr(values, 'tocsc')
+
+def wants_sparse(stored, genomes, samples, sparse_below):
+	# fewer than sparse_below of the genome x sample cells have reads (0: never, above 1: always) #
+	return stored < sparse_below * genomes * samples
+
+def with_layout(counts, rpkm, sparse_below=0):
+	# (counts, rpkm) in the layout -sparse_below asks for now, whichever layout they were cached in #
+	reads = counts_reads(counts)
+	stored = reads.nnz if is_sparse(reads) else np.count_nonzero(reads)
+	if wants_sparse(stored, reads.shape[0], reads.shape[1], sparse_below) == isinstance(counts, SparseFrame):
+		return counts, rpkm
+	if isinstance(counts, SparseFrame):
+		counts = counts.to_dense()
+	else:
+		from scipy.sparse import csc_matrix
+		counts = SparseFrame(csc_matrix(reads), counts.index, counts_samples(counts), genome_length=counts_lengths(counts))
+	return counts, counts_rpkm(counts, dtype=rpkm.dtype)
+
+def dense(df):
+	# DataFrame for the stages that need every cell (clustering, drawing) #
+	return df.to_dense() if isinstance(df, SparseFrame) else df
+
+def entries(values):
+	# (row indexer, column indexer, values) for elementwise math that works on both layouts: #
+	# broadcasting slices for a dense matrix, the (row, column) of every stored value for a CSC matrix #
+	if is_sparse(values):
+		return values.indices, np.repeat(np.arange(values.shape[1]), np.diff(values.indptr)), values.data
+	return (slice(None), None), (None, slice(None)), np.asarray(values)
+
+def with_data(values, data):
+	# result of entries() math back in the layout of values #
+	if not is_sparse(values):
+		return data
+	from scipy.sparse import csc_matrix
+	return csc_matrix((data, values.indices.copy(), values.indptr.copy()), shape=values.shape)
+
+def with_nan(values, rows, cols):
+	# a CSC result with the cells of rows/cols (bool masks) that it does not store set to NaN: the 0/0 cells the #
+	# dense division gives for a genome of length 0 or a sample without reads, so both layouts write the same table #
+	if not is_sparse(values) or not (rows.any() or cols.any()):
+		return values
+	from scipy.sparse import csc_matrix
+	genomes, samples = values.shape
+	at_rows, at_cols = np.flatnonzero(rows), np.flatnonzero(cols)
+	fill = csc_matrix((np.ones(len(at_rows) * samples + len(at_cols) * genomes),
+		(np.concatenate([np.repeat(at_rows, samples), np.tile(np.arange(genomes), len(at_cols))]),
+		np.concatenate([np.tile(np.arange(samples), len(at_rows)), np.repeat(at_cols, genomes)]))), shape=values.shape)
+	fill = csc_matrix(fill - fill.multiply(with_data(values, np.ones(len(values.data)))))
+	fill.eliminate_zeros()
+	fill.data = np.full(len(fill.data), np.nan, dtype=values.dtype)
+	return csc_matrix(values + fill)
+
+def column_sums(values):
+	return np.asarray(values.sum(axis=0)).ravel()
+
+def sparse_counts(gen_length_key, stats):
+	# counts as a SparseFrame: only the non-zero reads_mapped of every sample are kept (drops "*") #
+	from scipy.sparse import csc_matrix
+	keep = np.flatnonzero(gen_length_key.index != '*')
+	kept = np.full(len(gen_length_key), -1)
+	kept[keep] = np.arange(len(keep))
+	data, indices, indptr = [], [], [0]
+	for sample, df in stats:
+		rows = key_positions(gen_length_key.index, df.index)
+		rows = np.where(rows >= 0, kept[rows], -1)
+		reads = df['reads_mapped'].values
+		hit = np.flatnonzero((rows >= 0) & (reads > 0))
+		hit = hit[np.argsort(rows[hit], kind='mergesort')]
+		indices.append(rows[hit])
+		data.append(reads[hit])
+		indptr.append(indptr[-1] + len(hit))
+	reads = csc_matrix((np.concatenate(data).astype(np.uint64), np.concatenate(indices), np.asarray(indptr)), shape=(len(keep), len(stats)))
+	return SparseFrame(reads, gen_length_key.index[keep], pd.Index([sample for sample, df in stats]), genome_length=gen_length_key['genome_length'].values[keep])
+
+def counts_reads(counts):
+	# genomes x samples reads of a counts frame: numpy, or scipy.sparse CSC for a SparseFrame #
+	return counts.values if isinstance(counts, SparseFrame) else counts.iloc[0:,1:].values
+
+def counts_samples(counts):
+	return counts.columns if isinstance(counts, SparseFrame) else counts.columns[1:]
+
+def counts_lengths(counts):
+	return counts.genome_length if isinstance(counts, SparseFrame) else counts['genome_length'].values
+
+def counts_key(counts):
+	# genome length key (ACC --> genome_length) of a counts frame #
+	return pd.DataFrame({'genome_length': counts_lengths(counts)}, index=counts.index)
+
+###############
+# RPKM engine #
+###############
+
+def compute_rpkm(reads, genome_length, totals, dtype=np.float64):
+	# reads = genomes x samples (numpy or scipy.sparse), genome_length = bp per genome, totals = mapped reads per sample #
+	# RPKM = reads / ((gen_length/1.0E3)(tot_Reads_sample/1.0E6)) in one broadcast (sparse: over the stored cells only) #
+	at_rows, at_cols, values = entries(reads)
+	gl_kb = np.asarray(genome_length, dtype=np.float64) / 1000
+	tot_m = np.asarray(totals, dtype=np.float64) / 1000000
+	with np.errstate(divide='ignore', invalid='ignore'):
+		rpkm = with_data(reads, values.astype(dtype) / (gl_kb[at_rows] * tot_m[at_cols]).astype(dtype, copy=False))
+	return with_nan(rpkm, gl_kb == 0, tot_m == 0)
+
+def counts_rpkm(counts, dtype=np.float64):
+	# RPKM matrix aligned with the counts frame (genomes x samples, same order) #
+	reads = counts_reads(counts)
+	return compute_rpkm(reads, counts_lengths(counts), column_sums(reads), dtype=dtype)
+
+NORMS = ['rpkm', 'tpm', 'cpm', 'coverage']
+
+def unmapped_totals(stats):
+	# reads_unmapped of every row (incl. "*") summed per sample #
+	return pd.Series([df['reads_unmapped'].values.sum() for sample, df in stats], index=[sample for sample, df in stats], dtype=np.uint64)
+
+def normalize(counts, norm='rpkm', unmapped=None, dtype=np.float64, read_length=150):
+	# counts frame --> genomes x samples matrix in the chosen unit, aligned with counts #
+	# library size = mapped reads per sample, plus its unmapped reads when unmapped (Series by sample) is given #
+	#   rpkm = reads / (kb * million library reads)     cpm = reads / million library reads #
+	#   tpm = reads per kb, scaled to sum to 1E6 per sample (library size does not enter) #
+	#   coverage = reads * read_length / genome_length, the mean depth over the genome #
+	reads = counts_reads(counts)
+	genome_length = np.asarray(counts_lengths(counts), dtype=np.float64)
+	totals = column_sums(reads)
+	if unmapped is not None:
+		totals = totals + unmapped.reindex(counts_samples(counts)).fillna(0).values.astype(np.uint64)
+	if norm == 'rpkm':
+		return compute_rpkm(reads, genome_length, totals, dtype=dtype)
+	at_rows, at_cols, values = entries(reads)
+	values = np.asarray(values, dtype=np.float64)
+	# genomes/samples whose unstored (zero read) cells are 0/0 = NaN in the dense division #
+	nan_rows, nan_cols = np.zeros(reads.shape[0], dtype=bool), np.zeros(reads.shape[1], dtype=bool)
+	with np.errstate(divide='ignore', invalid='ignore'):
+		if norm == 'cpm':
+			values = values / (np.asarray(totals, dtype=np.float64)[at_cols] / 1000000)
+			nan_cols = np.asarray(totals) == 0
+		elif norm == 'tpm':
+			values = values / (genome_length[at_rows] / 1000)
+			nan_rows = genome_length == 0
+			if is_sparse(reads):
+				rpk_sums = np.bincount(at_cols, weights=values, minlength=reads.shape[1])
+				# a zero read cell of a length 0 genome is NaN in the dense sum, and so is then the whole sample #
+				stored = np.bincount(at_cols[nan_rows[at_rows]], minlength=reads.shape[1])
+				rpk_sums[stored < nan_rows.sum()] = np.nan
+			else:
+				rpk_sums = values.sum(axis=0)
+			values /= rpk_sums[at_cols] / 1000000
+			nan_cols = ~(rpk_sums > 0)
+		elif norm == 'coverage':
+			values = values * (read_length / genome_length)[at_rows]
+			nan_rows = genome_length == 0
+		else:
+			raise ValueError("unknown -norm "+str(norm)+" (choose from "+"/".join(NORMS)+")")
+	return with_nan(with_data(reads, values.astype(dtype, copy=False)), nan_rows, nan_cols)
+
+def rpkm_frame(counts, rpkm):
+	# rows ordered by genome length, samples ordered by name (same layout as the v1.1 stack/unstack output) #
+	samples = counts_samples(counts)
+	cols = np.argsort(samples.values, kind='mergesort')
+	rows = np.argsort(counts_lengths(counts), kind='mergesort')
+	if is_sparse(rpkm):
+		return SparseFrame(rpkm.tocsr()[rows].tocsc()[:, cols], counts.index[rows], samples[cols])
+	return pd.DataFrame(rpkm[np.ix_(rows, cols)], index=counts.index[rows], columns=samples[cols])
+
+###########
+# outputs #
+###########
+
+# name = the -norm of the matrix: <project>_rpkm.csv, <project>_tpm.csv, ... #
+
+def frame2_block(acc, reads, samples):
+	# v1.1 -count dump layout: reads_mapped and sample name of every sample side by side, columns numbered 0..2n-1 #
+	columns = {}
+	for col, sample in enumerate(samples):
+		columns[2*col] = reads[:, col]
+		columns[2*col+1] = sample
+	return pd.DataFrame(columns, index=pd.Index(acc, name='ACC'))
+
+def write_frame2(counts, out_prefix, block=4096):
+	# <project>_frame2.csv as v1.1 -count wrote it ("*" row last), in row blocks so sparse projects stay sparse #
+	reads = counts_reads(counts)
+	if is_sparse(reads):
+		reads = reads.tocsr()
+	samples = counts_samples(counts)
+	for start in range(0, counts.shape[0], block):
+		part = reads[start:start+block]
+		part = part.toarray() if is_sparse(part) else part
+		frame2_block(counts.index[start:start+block], part, samples).to_csv(out_prefix+"_frame2.csv", sep="\t", mode='w' if start == 0 else 'a', header=start == 0)
+	frame2_block(['*'], np.zeros((1, len(samples)), dtype=np.uint64), samples).to_csv(out_prefix+"_frame2.csv", sep="\t", mode='a', header=counts.shape[0] == 0)
+
+def write_counts(counts, out_prefix, frame2=False):
+	counts.to_csv(out_prefix+'_counts.csv', sep="\t")
+	if frame2:
+		write_frame2(counts, out_prefix)
+
+def write_npy(df_rpkm, out_prefix, name='rpkm', sparse=False, block=4096):
+	# memory-mappable copy of the matrix + one label per line sidecars for rows (genomes) and columns (samples) #
+	# a SparseFrame is densified into the .npy a block of rows at a time, or with sparse kept as a scipy.sparse #
+	# <project>_<name>.npz (loaded whole by open_rpkm); the other format of an earlier run is removed #
+	npy, npz = out_prefix+"_"+name+".npy", out_prefix+"_"+name+".npz"
+	if isinstance(df_rpkm, SparseFrame) and sparse:
+		from scipy.sparse import save_npz
+		save_npz(npz, df_rpkm.values)
+		stale = npy
+	elif isinstance(df_rpkm, SparseFrame):
+		rows = df_rpkm.values.tocsr()
+		out_mm = np.lib.format.open_memmap(npy, mode='w+', dtype=rows.dtype, shape=rows.shape)
+		for first in range(0, rows.shape[0], block):
+			out_mm[first:first+block] = rows[first:first+block].toarray()
+		out_mm.flush()
+		del out_mm
+		stale = npz
+	else:
+		np.save(npy, np.ascontiguousarray(df_rpkm.values))
+		stale = npz
+	if os.path.exists(stale):
+		os.remove(stale)
+	write_labels(df_rpkm.index, df_rpkm.columns, out_prefix, name=name)
+
+def write_labels(rows, cols, out_prefix, name='rpkm'):
+	for labels, suffix in ((rows, ".rows.txt"), (cols, ".cols.txt")):
+		with open(out_prefix+"_"+name+suffix, "w") as fh:
+			fh.writelines(str(label)+"\n" for label in labels)
+
+def write_rpkm(df_rpkm, out_prefix, npy=False, name='rpkm', npz=False):
+	df_rpkm.to_csv(out_prefix+"_"+name+".csv", sep="\t")
+	if npy:
+		write_npy(df_rpkm, out_prefix, name=name, sparse=npz)
+
+def open_rpkm(out_prefix, name='rpkm'):
+	# zero-copy view of <project>_rpkm.npy for downstream tools (the scipy.sparse matrix of a -npz one): (matrix, genomes, samples) #
+	if os.path.exists(out_prefix+"_"+name+".npy"):
+		rpkm = np.load(out_prefix+"_"+name+".npy", mmap_mode='r')
+	else:
+		from scipy.sparse import load_npz
+		rpkm = load_npz(out_prefix+"_"+name+".npz")
+	labels = []
+	for suffix in ("_"+name+".rows.txt", "_"+name+".cols.txt"):
+		with open(out_prefix+suffix) as fh:
+			labels.append(pd.Index(fh.read().splitlines()))
+	return rpkm, labels[0], labels[1]
+
+##################
+# streaming mode #
+##################
+
+# rough bytes held per genome x sample cell while a chunk is in flight (parsed frame + counts + RPKM) #
+STREAM_BYTES_PER_CELL = 96
+
+def stream_rpkm(files, out_prefix, chunk_size=None, max_memory=None, jobs=1, dtype=np.float64, sample_order=None, genome_order=None, npy=False,
+	norm='rpkm', unmapped=False, read_length=150, table=True, transpose=False):
+	# -count for matrices that do not fit in memory: samples are parsed chunk_size at a time, their #
+	# counts/RPKM columns go to disk-backed arrays and the CSVs are written from those in row blocks #
+	# the outputs are those of the in-memory -count: counts of every sample in input order, the -norm table #
+	# (only with table) sorted like sort_positions(), and samples x genomes with transpose (both sort lists) #
+	from scipy.sparse import csc_matrix
+	bundles = [file_ for file_ in files if file_.endswith(BUNDLE_SUFFIXES)]
+	if bundles:
+		raise ValueError("tar bundles are read whole, -chunk_size/-max_memory need one file per sample: "+listed(bundles))
+	samples = pd.Index([sample_name(file_) for file_ in files])
+	if samples.has_duplicates:
+		raise ValueError("samples found in more than one input file: "+listed(samples[samples.duplicated()].unique().tolist()))
+	key = read_stats(files[0])[1][['genome_length']]
+	genome_key = key.drop('*', errors='ignore')
+	acc = genome_key.index
+	if chunk_size is None:
+		chunk_size = max(1, int(max_memory * 2**20 // (len(acc) * STREAM_BYTES_PER_CELL)))
+	# rows by genome length and samples by name as rpkm_frame(), then the sort lists on an empty stand-in of that layout #
+	by_length = np.argsort(genome_key['genome_length'].values, kind='mergesort')
+	by_name = np.argsort(samples.values, kind='mergesort')
+	selection = sort_positions(SparseFrame(csc_matrix((len(acc), len(samples))), acc[by_length], samples[by_name]), sample_order, genome_order)
+	if table:
+		for line in selection['report']:
+			print("## "+line)
+	rows = by_length if selection['rows'] is None else np.where(selection['rows'] < 0, -1, by_length[selection['rows']])
+	cols = by_name if selection['cols'] is None else by_name[selection['cols']]
+	row_labels, col_labels = selection['row_labels'], selection['col_labels']
+	counts_mm = np.lib.format.open_memmap(out_prefix+"_counts.stream.npy", mode='w+', dtype=np.uint64, shape=(len(acc), len(samples)))
+	rpkm_mm = np.lib.format.open_memmap(out_prefix+"_rpkm.stream.npy", mode='w+', dtype=dtype, shape=(len(acc), len(samples))) if table else None
+	if table and npy:
+		shape, labels = ((len(cols), len(rows)), (col_labels, row_labels)) if transpose else ((len(rows), len(cols)), (row_labels, col_labels))
+		out_mm = np.lib.format.open_memmap(out_prefix+"_"+norm+".npy", mode='w+', dtype=dtype, shape=shape)
+		write_labels(labels[0], labels[1], out_prefix, name=norm)
+	try:
+		for start in range(0, len(files), chunk_size):
+			stats = load_stats(files[start:start+chunk_size], jobs=jobs)
+			genome_length_key(stats, key=key)
+			counts = build_counts(key, stats)
+			counts_mm[:, start:start+len(stats)] = counts.iloc[0:,1:].values
+			if table:
+				rpkm_mm[:, start:start+len(stats)] = normalize(counts, norm, unmapped_totals(stats) if unmapped else None, dtype=dtype, read_length=read_length)
+			print("## streamed samples "+str(start+len(stats))+"/"+str(len(files)))
+			del stats, counts
+		block = max(1, chunk_size * len(acc) // len(samples))
+		for start in range(0, len(acc), block):
+			counts = pd.DataFrame(counts_mm[start:start+block], index=acc[start:start+block], columns=samples)
+			counts.insert(0, 'genome_length', genome_key['genome_length'].values[start:start+block])
+			counts.to_csv(out_prefix+"_counts.csv", sep="\t", mode='w' if start == 0 else 'a', header=start == 0)
+			frame2_block(counts.index, counts.iloc[0:,1:].values, samples).to_csv(out_prefix+"_frame2.csv", sep="\t", mode='w' if start == 0 else 'a', header=start == 0)
+		frame2_block(['*'], np.zeros((1, len(samples)), dtype=np.uint64), samples).to_csv(out_prefix+"_frame2.csv", sep="\t", mode='a', header=False)
+		if table and not transpose:
+			for start in range(0, len(rows), block):
+				idx = rows[start:start+block]
+				values = rpkm_mm[np.where(idx < 0, 0, idx)][:, cols]
+				values[idx < 0] = np.nan
+				df_rpkm = pd.DataFrame(values, index=row_labels[start:start+block], columns=col_labels)
+				df_rpkm.to_csv(out_prefix+"_"+norm+".csv", sep="\t", mode='w' if start == 0 else 'a', header=start == 0)
+				if npy:
+					out_mm[start:start+len(idx)] = values
+		elif table:
+			# samples x genomes, a block of samples (all genomes) at a time #
+			block = max(1, chunk_size * len(acc) // max(1, len(rows)))
+			for start in range(0, len(cols), block):
+				values = rpkm_mm[:, cols[start:start+block]][np.where(rows < 0, 0, rows)]
+				values[rows < 0] = np.nan
+				df_rpkm = pd.DataFrame(values.T, index=col_labels[start:start+block], columns=row_labels)
+				df_rpkm.to_csv(out_prefix+"_"+norm+".csv", sep="\t", mode='w' if start == 0 else 'a', header=start == 0)
+				if npy:
+					out_mm[start:start+len(df_rpkm)] = values.T
+		if table and npy:
+			out_mm.flush()
+	finally:
+		del counts_mm, rpkm_mm
+		os.remove(out_prefix+"_counts.stream.npy")
+		if table:
+			os.remove(out_prefix+"_rpkm.stream.npy")
+
+#################
+# project cache #
+#################
+
+CACHE_VERSION = 3
+
+def stats_fingerprint(files):
+	# (path, size, mtime) of every input file, the key the cached matrix is stored under #
+	fingerprint = []
+	for file_ in files:
+		# a BAM's counts live in its index, so re-indexing is what invalidates the cache #
+		st = os.stat(bam_index(file_) or file_ if file_.endswith(".bam") else file_)
+		fingerprint.append([os.path.abspath(file_), st.st_size, st.st_mtime_ns])
+	return fingerprint
+
+def cache_arrays(name, values):
+	# a matrix as npz entries: itself, or the CSC data/indices/indptr/shape of a sparse one #
+	if is_sparse(values):
+		return {name+'_data': values.data, name+'_indices': values.indices, name+'_indptr': values.indptr, name+'_shape': np.asarray(values.shape)}
+	return {name: values}
+
+def cached_matrix(cache, name):
+	if name+'_indptr' in cache.files:
+		from scipy.sparse import csc_matrix
+		return csc_matrix((cache[name+'_data'], cache[name+'_indices'], cache[name+'_indptr']), shape=tuple(cache[name+'_shape']))
+	return cache[name]
+
+def save_cache(cache_file, fingerprint, counts, rpkm, unmapped):
+	# binary columnar copy of the project: labels, genome lengths, reads, per-sample mapped/unmapped totals, RPKM #
+	reads = counts_reads(counts)
+	samples = counts_samples(counts)
+	with open(cache_file, 'wb') as fh:
+		np.savez(fh, version=CACHE_VERSION, fingerprint=json.dumps(fingerprint),
+			acc=np.asarray(counts.index, dtype=str), samples=np.asarray(samples, dtype=str),
+			genome_length=counts_lengths(counts), totals=column_sums(reads),
+			unmapped=unmapped.reindex(samples).values.astype(np.uint64), **cache_arrays('reads', reads), **cache_arrays('rpkm', rpkm))
+
+def load_cache(cache_file):
+	# (fingerprint, counts, rpkm, unmapped) from the cache, None when there is no usable cache #
+	if not os.path.exists(cache_file):
+		return None
+	with np.load(cache_file) as cache:
+		if cache['version'] != CACHE_VERSION:
+			return None
+		reads = cached_matrix(cache, 'reads')
+		acc, samples = pd.Index(cache['acc'].astype(object), name='ACC'), pd.Index(cache['samples'].astype(object))
+		if is_sparse(reads):
+			counts = SparseFrame(reads, acc, samples, genome_length=cache['genome_length'])
+		else:
+			counts = pd.DataFrame(reads, index=acc, columns=samples)
+			counts.insert(0, 'genome_length', cache['genome_length'])
+		unmapped = pd.Series(cache['unmapped'], index=samples)
+		return json.loads(str(cache['fingerprint'])), counts, cached_matrix(cache, 'rpkm'), unmapped
+
+def fold_samples(counts, rpkm, unmapped, stats):
+	# new or re-parsed samples as appended (or replaced) columns of the project #
+	key = counts_key(counts)
+	genome_length_key(stats, key=key)
+	# new columns take the layout of the project (sparse_below > 1: always sparse) #
+	new = build_counts(key, stats, sparse_below=2 if isinstance(counts, SparseFrame) else 0)
+	new_rpkm = counts_rpkm(new, dtype=rpkm.dtype)
+	new_unmapped = unmapped_totals(stats)
+	unmapped = pd.concat([unmapped.drop(new_unmapped.index, errors='ignore'), new_unmapped])
+	if isinstance(counts, SparseFrame):
+		# old + new columns side by side, then one column take puts replacements in place and appends the rest #
+		from scipy.sparse import hstack
+		replaced = counts.columns.get_indexer(new.columns)
+		order = np.arange(len(counts.columns))
+		order[replaced[replaced >= 0]] = len(counts.columns) + np.flatnonzero(replaced >= 0)
+		order = np.concatenate([order, len(counts.columns) + np.flatnonzero(replaced < 0)])
+		counts = SparseFrame(hstack([counts.values, new.values]).tocsc()[:, order], counts.index,
+			counts.columns.append(new.columns[replaced < 0]), genome_length=counts.genome_length)
+		rpkm = hstack([rpkm, new_rpkm]).tocsc()[:, order]
+		return counts, rpkm, unmapped, new.columns.tolist()
+	replaced = counts.columns[1:].get_indexer(new.columns[1:])
+	for col, idx in enumerate(replaced):
+		if idx >= 0:
+			counts[new.columns[col+1]] = new.iloc[0:,col+1]
+			rpkm[:, idx] = new_rpkm[:, col]
+	appended = np.flatnonzero(replaced < 0)
+	if len(appended):
+		counts = pd.concat([counts, new.iloc[0:,appended+1]], axis=1)
+		rpkm = np.concatenate([rpkm, new_rpkm[:, appended]], axis=1)
+	return counts, rpkm, unmapped, new.columns[1:].tolist()
+
+def drop_samples(counts, rpkm, unmapped, samples):
+	# the project without the columns of samples #
+	keep = np.flatnonzero(~counts_samples(counts).isin(samples))
+	if not len(keep):
+		raise ValueError("no samples left in the project after dropping "+listed(samples))
+	unmapped = unmapped.drop(samples, errors='ignore')
+	if isinstance(counts, SparseFrame):
+		return SparseFrame(counts.values[:, keep], counts.index, counts.columns[keep], genome_length=counts.genome_length), rpkm[:, keep], unmapped
+	return counts.drop(columns=samples), rpkm[:, keep], unmapped
+
+def update_project(fingerprint, counts, rpkm, unmapped, files, jobs=1, watched=None):
+	# parse only new or modified idxstats files and fold them in as appended (or replaced) columns; samples stay in the #
+	# project when their file is not in files (-update of a directory of new files only), except for the files in #
+	# watched (-watch: files it saw in -i) which are dropped once they leave it #
+	known = {entry[0]: entry for entry in fingerprint}
+	current = stats_fingerprint(files)
+	changed = [entry for entry in current if known.get(entry[0]) != entry]
+	vanished = sorted((set(known) - {entry[0] for entry in current}) & set(watched or ()))
+	if not changed and not vanished:
+		return fingerprint, counts, rpkm, unmapped, [], []
+	new_samples = []
+	if changed:
+		counts, rpkm, unmapped, new_samples = fold_samples(counts, rpkm, unmapped, load_stats([entry[0] for entry in changed], jobs=jobs))
+	# a renamed (or newly compressed) file keeps its sample; the members of a removed bundle are not known here #
+	bundles = [path for path in vanished if path.endswith(BUNDLE_SUFFIXES)]
+	if bundles:
+		print("## removed bundles keep their samples in the project (re-run -count/-map to drop them): "+listed([os.path.basename(path) for path in bundles]))
+	dropped = sorted(({sample_name(path) for path in vanished if path not in bundles} - set(new_samples)) & set(counts_samples(counts)))
+	if dropped:
+		counts, rpkm, unmapped = drop_samples(counts, rpkm, unmapped, dropped)
+	for path in vanished:
+		del known[path]
+	for entry in changed:
+		known[entry[0]] = entry
+	return [*known.values()], counts, rpkm, unmapped, new_samples, dropped
+
+##############
+# clustering #
+##############
+
+LINKAGE_METHODS = ['average', 'complete', 'single', 'weighted', 'ward', 'centroid', 'median']
+
+def cluster_linkage(values, method='average', optimal=False):
+	# hierarchical clustering of the rows of values: condensed euclidean distances (n*(n-1)/2, one vectorized #
+	# pdist pass), linkage, and optionally the optimal leaf ordering (seriation, much slower on thousands of rows) #
+	from scipy.cluster.hierarchy import linkage, optimal_leaf_ordering
+	from scipy.spatial.distance import pdist
+	distances = pdist(values)
+	tree = linkage(distances, method=method)
+	if optimal:
+		tree = optimal_leaf_ordering(tree, distances)
+	return tree
+
+def matrix_digest(df, method, optimal):
+	# what a cached linkage was computed from: labels, values and clustering settings #
+	digest = hashlib.sha1(json.dumps([method, optimal, [str(label) for label in df.index], [str(label) for label in df.columns]]).encode())
+	digest.update(np.ascontiguousarray(df.values, dtype=np.float64).tobytes())
+	return digest.hexdigest()
+
+def auto_order(df_log, axis, cache_file=None, method='average', optimal=False):
+	# row (axis=0) or column (axis=1) labels of df_log in clustering order; the linkage is kept per axis in #
+	# cache_file and reused while the clustered matrix and settings are unchanged #
+	df = dense(df_log if axis == 0 else df_log.T).fillna(0)
+	labels = df.index.tolist()
+	if len(labels) < 3:
+		return labels
+	name = 'gen' if axis == 0 else 'samples'
+	digest = matrix_digest(df, method, optimal)
+	cached = {}
+	if cache_file and os.path.exists(cache_file):
+		with np.load(cache_file) as cache:
+			cached = {key: cache[key] for key in cache.files}
+	if str(cached.get(name+'_digest')) == digest:
+		tree = cached[name+'_linkage']
+		print("## reusing "+name+" clustering from "+cache_file)
+	else:
+		tree = cluster_linkage(df.values, method=method, optimal=optimal)
+		if cache_file:
+			cached.update({name+'_digest': digest, name+'_linkage': tree})
+			with open(cache_file, 'wb') as fh:
+				np.savez(fh, **cached)
+	from scipy.cluster.hierarchy import leaves_list
+	return [labels[leaf] for leaf in leaves_list(tree)]
+
+##########
+# stages #
+##########
+
+def load_counts(files, jobs=1, sparse_below=0):
+	# idxstats files --> counts frame (genome_length + one reads_mapped column per sample) #
+	stats = load_stats(files, jobs=jobs)
+	return build_counts(genome_length_key(stats), stats, sparse_below=sparse_below)
+
+def read_sort_list(file_):
+	# sample/genome ids: one tab-separated line (v1.1) or one id per line (first tab field, so extra columns are allowed) #
+	with open(file_, "r") as fh:
+		lines = [line.rstrip("\r\n") for line in fh if line.strip()]
+	fields = lines[0].split("\t") if len(lines) == 1 else [line.split("\t")[0] for line in lines]
+	return [id_.strip() for id_ in fields if id_.strip()]
+
+def label_positions(labels, ids):
+	# ids --> integer positions in labels through the labels' hash index (-1 = not found) #
+	# repeated ids keep their first place; returns (positions, ids, unmatched ids, duplicated ids) #
+	ids = pd.Index(ids, name=labels.name)
+	duplicated = ids[ids.duplicated()].unique().tolist()
+	ids = ids.drop_duplicates()
+	positions = labels.get_indexer(ids)
+	return positions, ids, ids[positions < 0].tolist(), duplicated
+
+def listed(ids, limit=10):
+	return ", ".join(str(id_) for id_ in ids[:limit]) + (" ..." if len(ids) > limit else "")
+
+def sort_positions(df_rpkm, sort_samples=None, sort_gen=None):
+	# resolve the id lists once into integer row/column positions (reusable on any frame with the same labels) #
+	# samples without data are an error; genomes without data stay in place as empty (NaN) rows #
+	selection = {'rows': None, 'row_labels': df_rpkm.index, 'cols': None, 'col_labels': df_rpkm.columns, 'report': []}
+	if sort_samples is not None:
+		cols, col_labels, unmatched, duplicated = label_positions(df_rpkm.columns, sort_samples)
+		if unmatched:
+			raise ValueError("samples without a .stats/.bam file: "+", ".join(map(str, unmatched)))
+		if duplicated:
+			selection['report'].append("-sort_samples lists "+str(len(duplicated))+" ids more than once (first kept): "+listed(duplicated))
+		if len(cols) < df_rpkm.shape[1]:
+			selection['report'].append("-sort_samples leaves out "+str(df_rpkm.shape[1] - len(cols))+" samples")
+		selection.update(cols=cols, col_labels=col_labels)
+	if sort_gen is not None:
+		rows, row_labels, unmatched, duplicated = label_positions(df_rpkm.index, sort_gen)
+		if unmatched:
+			selection['report'].append("-sort_gen has "+str(len(unmatched))+" ids not in the matrix (left empty): "+listed(unmatched))
+		if duplicated:
+			selection['report'].append("-sort_gen lists "+str(len(duplicated))+" ids more than once (first kept): "+listed(duplicated))
+		if len(rows) - len(unmatched) < df_rpkm.shape[0]:
+			selection['report'].append("-sort_gen leaves out "+str(df_rpkm.shape[0] - len(rows) + len(unmatched))+" genomes")
+		selection.update(rows=rows, row_labels=row_labels)
+	return selection
+
+def take_rpkm(df_rpkm, selection):
+	# apply sort_positions() as integer takes on the value array (row position -1 --> NaN row) #
+	if isinstance(df_rpkm, SparseFrame):
+		return take_sparse(df_rpkm, selection)
+	values = df_rpkm.values
+	if selection['cols'] is not None:
+		values = values.take(selection['cols'], axis=1)
+	if selection['rows'] is not None:
+		rows = selection['rows']
+		values = values.take(np.where(rows < 0, 0, rows), axis=0)
+		if (rows < 0).any():
+			values = values.astype(np.result_type(values.dtype, np.float32))
+			values[rows < 0] = np.nan
+	return pd.DataFrame(values, index=selection['row_labels'], columns=selection['col_labels'])
+
+def take_sparse(df_rpkm, selection):
+	# take_rpkm for a SparseFrame: a 0/1 row selector product, missing genomes added as explicit NaN rows #
+	from scipy.sparse import csr_matrix
+	values = df_rpkm.values
+	if selection['cols'] is not None:
+		values = values[:, selection['cols']]
+	if selection['rows'] is not None:
+		rows = selection['rows']
+		found = np.flatnonzero(rows >= 0)
+		picker = csr_matrix((np.ones(len(found), dtype=values.dtype), (found, rows[found])), shape=(len(rows), values.shape[0]))
+		values = picker @ values
+		missing = np.flatnonzero(rows < 0)
+		if len(missing):
+			ncols = values.shape[1]
+			values = values.astype(np.result_type(values.dtype, np.float32)) + csr_matrix((np.full(len(missing) * ncols, np.nan),
+				(np.repeat(missing, ncols), np.tile(np.arange(ncols), len(missing)))), shape=values.shape)
+	return SparseFrame(values, selection['row_labels'], selection['col_labels'])
+
+def sort_rpkm(df_rpkm, sort_samples=None, sort_gen=None):
+	# select/order samples (columns) and genomes (rows) by the given id lists #
+	return take_rpkm(df_rpkm, sort_positions(df_rpkm, sort_samples, sort_gen))
+
+##########
+# groups #
+##########
+
+GROUP_STATS = ['mean', 'median', 'prevalence']
+
+def read_groups(groups, samples):
+	# -group: a sample \t group file, or a regex whose first capture group (else the whole match) names the group #
+	# --> one group per sample, None where the sample is not grouped #
+	if os.path.isfile(groups):
+		with open(groups, "r") as fh:
+			mapping = dict(line.rstrip("\r\n").split("\t")[:2] for line in fh if "\t" in line)
+		return [mapping.get(str(sample)) for sample in samples]
+	try:
+		pattern = re.compile(groups)
+	except re.error as err:
+		raise ValueError("-group "+groups+" is neither a file nor a regex ("+str(err)+")")
+	found = [pattern.search(str(sample)) for sample in samples]
+	return [None if match is None else match.group(1 if pattern.groups else 0) for match in found]
+
+def group_rpkm(df_rpkm, groups, stat='mean'):
+	# genomes x samples --> genomes x groups (in order of first appearance), samples with group None left out #
+	# columns are sorted by group once, then every group is reduced with one reduceat over its column block #
+	keep = np.array([group is not None for group in groups], dtype=bool)
+	if not keep.any():
+		raise ValueError("-group matches none of the samples")
+	if stat not in GROUP_STATS:
+		raise ValueError("unknown -group_stat "+str(stat)+" (choose from "+"/".join(GROUP_STATS)+")")
+	codes, names = pd.factorize(np.asarray(groups, dtype=object)[keep])
+	order = np.argsort(codes, kind='mergesort')
+	sizes = np.bincount(codes)
+	starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+	columns = np.flatnonzero(keep)[order]
+	if isinstance(df_rpkm, SparseFrame):
+		# sums per group as one product with a samples x groups indicator; medians densify one group at a time #
+		from scipy.sparse import csr_matrix
+		values = df_rpkm.values[:, columns]
+		indicator = csr_matrix((np.ones(len(columns)), (np.arange(len(columns)), codes[order])), shape=(len(columns), len(sizes)))
+		if stat == 'mean':
+			grouped = (values.astype(np.float64) @ indicator).toarray() / sizes
+		elif stat == 'prevalence':
+			grouped = ((values > 0).astype(np.float64) @ indicator).toarray() / sizes
+		else:
+			grouped = np.column_stack([np.median(values[:, start:start+size].toarray(), axis=1) for start, size in zip(starts, sizes)])
+		return pd.DataFrame(grouped, index=df_rpkm.index, columns=pd.Index(names, name='group'))
+	values = np.asarray(df_rpkm.values, dtype=np.float64)[:, columns]
+	if stat == 'mean':
+		grouped = np.add.reduceat(values, starts, axis=1) / sizes
+	elif stat == 'prevalence':
+		grouped = np.add.reduceat((values > 0).astype(np.uint32), starts, axis=1) / sizes
+	else:
+		grouped = np.column_stack([np.median(values[:, start:start+size], axis=1) for start, size in zip(starts, sizes)])
+	return pd.DataFrame(grouped, index=df_rpkm.index, columns=pd.Index(names, name='group'))
+
+TRANSFORMS = ['log10', 'log2', 'log1p', 'none']
+
+def transform_matrix(df_rpkm, transform='log10'):
+	# log10/log2 floor everything below 1 (and 0 --> -inf) to 0 as v1.1 did; log1p and none keep every value #
+	# all of them map 0 to 0, so a SparseFrame is transformed on its stored cells only #
+	if isinstance(df_rpkm, SparseFrame):
+		values = with_data(df_rpkm.values, transform_matrix(df_rpkm.values.data, transform))
+		values.eliminate_zeros()
+		return SparseFrame(values, df_rpkm.index, df_rpkm.columns)
+	if transform == 'none':
+		return df_rpkm
+	if transform == 'log1p':
+		return np.log1p(df_rpkm)
+	if transform not in TRANSFORMS:
+		raise ValueError("unknown -transform "+str(transform)+" (choose from "+"/".join(TRANSFORMS)+")")
+	df_rpkm = np.log10(df_rpkm) if transform == 'log10' else np.log2(df_rpkm)
+	df_rpkm[df_rpkm < 0] = 0
+	return df_rpkm
+
+def log_rpkm(df_rpkm):
+	# log10 RPKM with everything below 1 RPKM (and 0 --> -inf) floored to 0 #
+	return transform_matrix(df_rpkm, 'log10')
+
+COLORMAPS = {
+	'plasma': ['#FFFF99','#efe350ff','#f7cb44ff','#f9b641ff','#f9a242ff',\
+	'#f68f46ff','#eb8055ff','#de7065ff','#cc6a70ff','#b8627dff','#a65c85ff','#90548bff','#7e4e90ff','#6b4596ff','#593d9cff',\
+	'#403891ff','#253582ff','#13306dff','#0c2a50ff','#042333ff'],
+	'viridis': ['#FFFF99','#DCE319FF','#B8DE29FF','#95D840FF','#73D055FF',\
+	'#55C667FF','#3CBB75FF','#29AF7FFF','#20A387FF','#1F968BFF','#238A8DFF','#287D8EFF','#2D708EFF','#33638DFF','#39568CFF',\
+	'#404788FF','#453781FF','#482677FF','#481567FF','#440154FF'],
+	'blue': ['#99FFFF','#6699FF','#0000CC','#000099','#000066'],
+	'red': ['#FFCCCC','#FF6666','#CC3333','#990000','#660000'],
+	'green': ['#CCFFCC','#66CC66','#339933','#006600','#003300'],
+}
+
+# colours per palette: v1.1 built 10,000,000-entry tables (and a 10M-cell colorbar); #
+# 4096 levels is already finer than an 8-bit PNG channel can show between two stops #
+COLORMAP_N = 4096
+
+colormap_cache = {}
+
+def read_palette(palette_file):
+	# user palette: one colour per line (hex or matplotlib name), lowest value first #
+	with open(palette_file, "r") as fh:
+		return [line.rstrip("\n").split("\t")[0] for line in fh if line.strip()]
+
+def get_colormap(colors=None):
+	# -colors name or palette file --> colormap, built once per process #
+	name = colors or 'plasma'
+	key = (name, os.path.getmtime(name)) if name not in COLORMAPS and os.path.isfile(name) else (name, None)
+	if key not in colormap_cache:
+		from matplotlib.colors import LinearSegmentedColormap
+		if name in COLORMAPS:
+			stops = COLORMAPS[name]
+		elif key[1] is not None:
+			stops = read_palette(name)
+		else:
+			raise ValueError("unknown -colors "+name+" (choose from "+"/".join(COLORMAPS)+" or give a palette file)")
+		colormap_cache[key] = LinearSegmentedColormap.from_list('colorbar', stops, N=COLORMAP_N)
+	return colormap_cache[key]
+
+# one style for every sort mode; render_heatmap(style={...}) overrides single entries #
+HEATMAP_STYLE = {
+	'xtick_fontsize': 1.5,
+	'ytick_fontsize': 0.05,
+	'xticks': 'on',
+	'yticks': 'on',
+	'dpi': 900,
+	'renderer': 'raster',
+	'phylo_strip': False,
+}
+
+def read_phylo_colors(phylo_colors):
+	# Genome \t Order \t Color --> frame indexed by genome id with its order and colour, parsed once per run #
+	from matplotlib.colors import is_color_like
+	genomes, orders, colors = [], [], []
+	with open(phylo_colors, "r") as phylo:
+		for number, line in enumerate(phylo, 1):
+			tabs = line.rstrip("\r\n").split("\t")
+			if not line.strip():
+				continue
+			if len(tabs) < 3 or not tabs[1].strip().lstrip('-').isdigit():
+				raise ValueError(phylo_colors+" line "+str(number)+": expected Genome<tab>Order<tab>Color (see -phy_col_format)")
+			if not is_color_like(tabs[2].strip()):
+				raise ValueError(phylo_colors+" line "+str(number)+": "+repr(tabs[2].strip())+" is not a colour name or hex code (see -phy_col_format)")
+			genomes.append(tabs[0].strip())
+			orders.append(int(tabs[1]))
+			colors.append(tabs[2].strip())
+	index = pd.DataFrame({'order': orders, 'color': colors}, index=pd.Index(genomes, name='ACC'))
+	return index[~index.index.duplicated()]
+
+def phylo_label_colors(phylo, labels):
+	# colour of every label (None: not in the file), looked up by genome id in one reindex #
+	colors = phylo['color'].reindex(pd.Index(labels).astype(str))
+	return [color if isinstance(color, str) else None for color in colors]
+
+def render_heatmap(df_rpkm, out_png, colors=None, phylo_colors=None, style=None):
+	# draw an already sorted/transformed matrix (genomes x samples) to out_png, see HEATMAP_STYLE #
+	# renderer = raster (one image, cost follows output pixels) or pcolor (v1.1: one polygon per cell) #
+	# phylo_colors = file or read_phylo_colors() frame: genome labels are coloured by id on whichever axis holds them, #
+	# or with phylo_strip drawn as one colour strip beside the rows #
+	style = dict(HEATMAP_STYLE, **(style or {}))
+	# tick labels are kept at one pixel or more at the chosen dpi (FreeType cannot size smaller text, e.g. 0.05pt at dpi 30) #
+	for key in ('xtick_fontsize', 'ytick_fontsize'):
+		style[key] = max(style[key], 72 / style['dpi'])
+	df_rpkm = dense(df_rpkm)
+	if isinstance(phylo_colors, str):
+		phylo_colors = read_phylo_colors(phylo_colors)
+	colormap_1 = get_colormap(colors)
+	# a private Figure (no pyplot state), so several renders can share a process or run side by side #
+	from matplotlib.figure import Figure
+	from matplotlib.backends.backend_agg import FigureCanvasAgg
+	fig = Figure()
+	FigureCanvasAgg(fig)
+	ax = fig.gca()
+	if style['renderer'] == 'pcolor':
+		leg_color = ax.pcolor(df_rpkm, cmap=colormap_1)
+	else:
+		leg_color = ax.imshow(np.asarray(df_rpkm.values, dtype=float), cmap=colormap_1, aspect='auto', interpolation='nearest',
+			origin='lower', extent=(0, df_rpkm.shape[1], 0, df_rpkm.shape[0]))
+	if style['yticks'] == 'off':
+		ax.set_yticks([])
+	else:
+		ax.set_yticks(np.arange(0.2, len(df_rpkm.index), 1))
+		ax.set_yticklabels(df_rpkm.index, fontsize=style['ytick_fontsize'])
+	if style['xticks'] == 'off':
+		ax.set_xticks([])
+	else:
+		ax.set_xticks(np.arange(0.2, len(df_rpkm.columns), 1))
+		ax.set_xticklabels(df_rpkm.columns, fontsize=style['xtick_fontsize'], rotation=90)
+	if phylo_colors is not None:
+		row_colors = phylo_label_colors(phylo_colors, df_rpkm.index)
+		col_colors = phylo_label_colors(phylo_colors, df_rpkm.columns)
+		if not any(row_colors) and not any(col_colors):
+			# no genome id of the file is on the heatmap: v1.1 files colour the Order-th row #
+			print("## -phylo_colors: none of its genomes are on the heatmap, colouring rows by their Order column")
+			row_colors = [None] * len(df_rpkm.index)
+			for order, color in zip(phylo_colors['order'], phylo_colors['color']):
+				if 0 <= order < len(row_colors):
+					row_colors[order] = color
+		if style['phylo_strip'] and any(row_colors):
+			from matplotlib.colors import to_rgba
+			from mpl_toolkits.axes_grid1 import make_axes_locatable
+			strip = make_axes_locatable(ax).append_axes("left", size="2%", pad=0.01, sharey=ax)
+			palette = {color: to_rgba(color) for color in set(row_colors) if color}
+			strip.imshow(np.array([[palette.get(color, (0, 0, 0, 0))] for color in row_colors]), aspect='auto', interpolation='nearest',
+				origin='lower', extent=(0, 1, 0, df_rpkm.shape[0]))
+			strip.set_xticks([])
+			strip.tick_params(axis='y', labelsize=style['ytick_fontsize'])
+			ax.tick_params(axis='y', left=False, labelleft=False)
+		else:
+			for axis_labels, label_colors, shown in ((ax.get_yticklabels(), row_colors, style['yticks']), (ax.get_xticklabels(), col_colors, style['xticks'])):
+				if shown == 'off':
+					continue
+				for label, color in zip(axis_labels, label_colors):
+					if color:
+						label.set_color(color)
+	ax.invert_yaxis()
+	# the colorbar takes its room from the heatmap ax (not the -phylo_strip axes that older matplotlib would pick #
+	# as gca()), before tight_layout() lays the figure out #
+	fig.colorbar(leg_color, ax=ax)
+	fig.tight_layout()
+	fig.savefig(out_png, dpi=style['dpi'])
+
+#########
+# tiles #
+#########
+
+TILE_PX = 256
+
+TILE_VIEWER = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>%(title)s</title>
+<style>
+body{margin:0;font:12px sans-serif}
+#bar{height:26px;line-height:26px;padding:0 6px;background:#eee;white-space:nowrap;overflow:hidden}
+#view{position:absolute;top:26px;left:0;right:0;bottom:0;overflow:hidden;background:#fff;cursor:grab}
+#view img{position:absolute;image-rendering:pixelated;user-select:none;pointer-events:none}
+</style></head>
+<body><div id="bar"><button id="in">+</button><button id="out">-</button> <b>%(title)s</b> <span id="info"></span></div>
+<div id="view"></div>
+<script>
+var meta = %(meta)s;
+var view = document.getElementById('view'), info = document.getElementById('info');
+var z = 0, ox = 0, oy = 0, tiles = {}, drag = null;
+function scale(){ return Math.pow(2, meta.max_z - z); }
+function draw(){
+	var t = meta.tile, w = meta.width / scale(), h = meta.height / scale(), keep = {};
+	for (var ty = Math.max(0, Math.floor(-oy / t)); ty * t < h && ty * t + oy < view.clientHeight; ty++){
+		for (var tx = Math.max(0, Math.floor(-ox / t)); tx * t < w && tx * t + ox < view.clientWidth; tx++){
+			var key = z + '/' + tx + '_' + ty;
+			keep[key] = 1;
+			if (!tiles[key]){ tiles[key] = new Image(); tiles[key].src = key + '.png?v=' + meta.version; view.appendChild(tiles[key]); }
+			tiles[key].style.left = (tx * t + ox) + 'px';
+			tiles[key].style.top = (ty * t + oy) + 'px';
+		}
+	}
+	for (var k in tiles){ if (!keep[k]){ view.removeChild(tiles[k]); delete tiles[k]; } }
+}
+function zoom(dz, cx, cy){
+	var nz = Math.min(meta.max_z, Math.max(0, z + dz));
+	if (nz == z) return;
+	var f = Math.pow(2, nz - z);
+	ox = cx - (cx - ox) * f; oy = cy - (cy - oy) * f; z = nz; draw();
+}
+view.onwheel = function(e){ e.preventDefault(); zoom(e.deltaY < 0 ? 1 : -1, e.offsetX, e.offsetY); };
+view.onmousedown = function(e){ drag = [e.clientX - ox, e.clientY - oy]; view.style.cursor = 'grabbing'; };
+window.onmouseup = function(){ drag = null; view.style.cursor = 'grab'; };
+view.onmousemove = function(e){
+	if (drag){ ox = e.clientX - drag[0]; oy = e.clientY - drag[1]; draw(); return; }
+	var row = Math.floor((e.offsetY - oy) * scale() / meta.cell_px), col = Math.floor((e.offsetX - ox) * scale() / meta.cell_px);
+	info.textContent = (row >= 0 && row < meta.rows.length && col >= 0 && col < meta.cols.length) ? meta.rows[row] + '  |  ' + meta.cols[col] : '';
+};
+document.getElementById('in').onclick = function(){ zoom(1, view.clientWidth / 2, view.clientHeight / 2); };
+document.getElementById('out').onclick = function(){ zoom(-1, view.clientWidth / 2, view.clientHeight / 2); };
+window.onresize = draw;
+draw();
+</script></body></html>
+"""
+
+# per-process copy of the quantized matrix for the tile workers #
+tile_state = {}
+
+def init_tile_worker(cells, lut, max_z, cell_px, out_dir):
+	tile_state.update(cells=cells, lut=lut, max_z=max_z, cell_px=cell_px, out_dir=out_dir)
+
+def tile_span(tile, z, max_z, cell_px, length):
+	# matrix rows/cols [first, last) drawn by tile number `tile` of level z along one axis #
+	scale = 2 ** (max_z - z)
+	first = tile * TILE_PX * scale // cell_px
+	last = min(length, -(-(tile + 1) * TILE_PX * scale // cell_px))
+	return first, last
+
+def pool_cells(cells, starts, axis):
+	# highest LUT index of the cells from each start up to the next one (the end of cells) along axis, NaN cells only #
+	# where all of them are; a repeated start (a cell wider than a pixel) just gives that cell again #
+	values = cells.astype(np.int32)
+	values[values == COLORMAP_N] = -1
+	pooled = np.maximum.reduceat(values, starts - starts[0], axis=axis)
+	pooled[pooled < 0] = COLORMAP_N
+	return pooled.astype(np.uint16)
+
+def write_tile(tile):
+	# one TILE_PX x TILE_PX (or smaller, at the edges) tile straight through the colour LUT; where a pixel covers #
+	# several cells (levels above the cell_px one) it shows the highest of them, so isolated hits stay visible #
+	from matplotlib.image import imsave
+	z, tx, ty = tile
+	cells, cell_px, max_z = tile_state['cells'], tile_state['cell_px'], tile_state['max_z']
+	scale = 2 ** (max_z - z)
+	ys = (ty * TILE_PX + np.arange(TILE_PX)) * scale // cell_px
+	xs = (tx * TILE_PX + np.arange(TILE_PX)) * scale // cell_px
+	ys, xs = ys[ys < cells.shape[0]], xs[xs < cells.shape[1]]
+	last_y = tile_span(ty, z, max_z, cell_px, cells.shape[0])[1]
+	last_x = tile_span(tx, z, max_z, cell_px, cells.shape[1])[1]
+	block = cells[ys[0]:last_y, xs[0]:last_x]
+	if scale > cell_px:
+		block = pool_cells(pool_cells(block, ys, 0), xs, 1)
+	else:
+		block = block[np.ix_(ys - ys[0], xs - xs[0])]
+	os.makedirs(os.path.join(tile_state['out_dir'], str(z)), exist_ok=True)
+	imsave(os.path.join(tile_state['out_dir'], str(z), "%d_%d.png" % (tx, ty)), tile_state['lut'][block])
+
+def row_blocks(df, block=4096):
+	# (first row, float array) of block rows at a time, a SparseFrame densified one block at a time #
+	rows = df.values.tocsr() if isinstance(df, SparseFrame) else df.values
+	for first in range(0, rows.shape[0], block):
+		part = rows[first:first+block]
+		yield first, part.toarray().astype(float) if is_sparse(part) else np.asarray(part, dtype=float)
+
+def render_tiles(df_rpkm, out_dir, colors=None, cell_px=4, jobs=1, title="rpkm_heater"):
+	# multi-resolution PNG tile pyramid + index.html viewer; the deepest level shows each cell as cell_px pixels and #
+	# each level above halves it. Tiles whose cells did not change since the last render in out_dir are kept #
+	# (only the uint16 colour indices of the matrix are held whole, the values are quantized a block of rows at a time) #
+	vmin, vmax = np.inf, -np.inf
+	for first, values in row_blocks(df_rpkm):
+		finite = values[np.isfinite(values)]
+		if finite.size:
+			vmin, vmax = min(vmin, finite.min()), max(vmax, finite.max())
+	if vmin > vmax:
+		vmin, vmax = 0.0, 1.0
+	cells = np.full(df_rpkm.shape, COLORMAP_N, dtype=np.uint16)
+	for first, values in row_blocks(df_rpkm):
+		finite = np.isfinite(values)
+		scaled = (values[finite] - vmin) / ((vmax - vmin) or 1) * (COLORMAP_N - 1)
+		block = cells[first:first+len(values)]
+		block[finite] = np.clip(np.rint(scaled), 0, COLORMAP_N - 1)
+	lut = np.vstack([np.rint(get_colormap(colors)(np.linspace(0, 1, COLORMAP_N)) * 255), [[0, 0, 0, 0]]]).astype(np.uint8)
+	height, width = cells.shape[0] * cell_px, cells.shape[1] * cell_px
+	max_z = max(0, int(np.ceil(np.log2(max(height, width, 1) / TILE_PX))))
+	# cells.npy holds LUT indices, so a new palette (-colors, or an edited palette file) redraws every tile #
+	meta = {'tile': TILE_PX, 'max_z': max_z, 'cell_px': cell_px, 'width': width, 'height': height, 'colors': colors or 'plasma',
+		'palette': hashlib.sha1(lut.tobytes()).hexdigest(),
+		'vmin': float(vmin), 'vmax': float(vmax), 'rows': [str(label) for label in df_rpkm.index], 'cols': [str(label) for label in df_rpkm.columns]}
+
+	changed = None
+	if os.path.exists(os.path.join(out_dir, "meta.json")) and os.path.exists(os.path.join(out_dir, "cells.npy")):
+		with open(os.path.join(out_dir, "meta.json")) as fh:
+			previous = json.load(fh)
+		if all(previous.get(key) == meta[key] for key in ('max_z', 'cell_px', 'width', 'height', 'rows', 'cols', 'palette')):
+			changed = np.load(os.path.join(out_dir, "cells.npy")) != cells
+		meta['version'] = previous.get('version', 0) + 1
+	if changed is None:
+		shutil.rmtree(out_dir, ignore_errors=True)
+		meta.setdefault('version', 0)
+	os.makedirs(out_dir, exist_ok=True)
+
+	todo = []
+	for z in range(max_z + 1):
+		scale = 2 ** (max_z - z)
+		for ty in range(-(-height // (TILE_PX * scale))):
+			rows = tile_span(ty, z, max_z, cell_px, cells.shape[0])
+			for tx in range(-(-width // (TILE_PX * scale))):
+				cols = tile_span(tx, z, max_z, cell_px, cells.shape[1])
+				if changed is None or changed[rows[0]:rows[1], cols[0]:cols[1]].any():
+					todo.append((z, tx, ty))
+	if jobs > 1 and len(todo) > 1:
+		with ProcessPoolExecutor(max_workers=jobs, initializer=init_tile_worker, initargs=(cells, lut, max_z, cell_px, out_dir)) as pool:
+			for done in pool.map(write_tile, todo, chunksize=16):
+				pass
+	else:
+		init_tile_worker(cells, lut, max_z, cell_px, out_dir)
+		for tile in todo:
+			write_tile(tile)
+
+	np.save(os.path.join(out_dir, "cells.npy"), cells)
+	with open(os.path.join(out_dir, "meta.json"), "w") as fh:
+		json.dump(meta, fh)
+	with open(os.path.join(out_dir, "index.html"), "w") as fh:
+		fh.write(TILE_VIEWER % {'title': title, 'meta': json.dumps(meta)})
+	return len(todo)
+
+#############
+# profiling #
+#############
+
+PROFILE_STAGES = ['parse', 'assemble', 'normalize', 'sort', 'render', 'write', 'stream']
+
+def proc_status_mb(field):
+	# VmRSS (resident now) / VmHWM (resident peak) of this process in MB, None where /proc is not available #
+	try:
+		with open("/proc/self/status", "r") as fh:
+			for line in fh:
+				if line.startswith(field+":"):
+					return int(line.split()[1]) / 1024
+	except OSError:
+		pass
+	return None
+
+def reset_peak_rss():
+	# restart the VmHWM high-water mark (Linux >= 4.0) so it measures one stage; False when only the process peak is known #
+	try:
+		with open("/proc/self/clear_refs", "w") as fh:
+			fh.write("5")
+		return proc_status_mb('VmHWM') is not None
+	except OSError:
+		return False
+
+def process_peak_mb():
+	try:
+		import resource
+	except ImportError:
+		return None
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	return peak / 2**20 if sys.platform == 'darwin' else peak / 1024
+
+def cpu_seconds():
+	# user + system CPU of this process and of its finished children (the -jobs process pools) #
+	times = os.times()
+	return times.user + times.system + times.children_user + times.children_system
+
+def new_profile(dump_stage=None, dump='cprofile', out_prefix=None):
+	return {'stages': {}, 'dump_stage': dump_stage, 'dump': dump, 'out_prefix': out_prefix,
+		'wall_start': time.perf_counter(), 'cpu_start': cpu_seconds(), 'profiler': None}
+
+@contextlib.contextmanager
+def stage(profile, name):
+	# add the wall time, CPU time and peak RSS of the enclosed step to profile['stages'][name] (profile None: no-op) #
+	# the -profile_stage step additionally runs under cProfile or tracemalloc #
+	if profile is None:
+		yield
+		return
+	dump = profile['dump'] if profile['dump_stage'] == name else None
+	if dump == 'cprofile':
+		import cProfile
+		profile['profiler'] = profile['profiler'] or cProfile.Profile()
+		profile['profiler'].enable()
+	elif dump == 'tracemalloc':
+		import tracemalloc
+		tracemalloc.start(25)
+	scoped = reset_peak_rss()
+	wall, cpu = time.perf_counter(), cpu_seconds()
+	try:
+		yield
+	finally:
+		wall, cpu = time.perf_counter() - wall, cpu_seconds() - cpu
+		peak = proc_status_mb('VmHWM') if scoped else process_peak_mb()
+		record = profile['stages'].setdefault(name, {'calls': 0, 'wall_s': 0.0, 'cpu_s': 0.0, 'peak_rss_mb': None})
+		record['calls'] += 1
+		record['wall_s'] += wall
+		record['cpu_s'] += cpu
+		if peak is not None:
+			record['peak_rss_mb'] = max(peak, record['peak_rss_mb'] or 0)
+		record['peak_rss_scope'] = 'stage' if scoped else 'process'
+		record['rss_end_mb'] = proc_status_mb('VmRSS')
+		if dump == 'cprofile':
+			profile['profiler'].disable()
+			profile['profiler'].dump_stats(profile['out_prefix']+"_profile_"+name+".prof")
+		elif dump == 'tracemalloc':
+			import tracemalloc
+			snapshot, (current, traced_peak) = tracemalloc.take_snapshot(), tracemalloc.get_traced_memory()
+			tracemalloc.stop()
+			with open(profile['out_prefix']+"_profile_"+name+".tracemalloc.txt", "w" if record['calls'] == 1 else "a") as fh:
+				fh.write("# %s call %d: traced peak %.1f MB, still allocated %.1f MB\n" % (name, record['calls'], traced_peak / 2**20, current / 2**20))
+				fh.writelines(str(line)+"\n" for line in snapshot.statistics('lineno')[:40])
+
+def write_profile(profile, report_file, argv):
+	# machine readable stage report: where the time and memory of a run went #
+	report = {'argv': argv, 'python': sys.version.split()[0], 'numpy': np.__version__, 'pandas': pd.__version__,
+		'cpu_count': os.cpu_count(), 'matrix': profile.get('matrix'),
+		'total': {'wall_s': time.perf_counter() - profile['wall_start'], 'cpu_s': cpu_seconds() - profile['cpu_start'], 'peak_rss_mb': process_peak_mb()},
+		'stages': {name: profile['stages'][name] for name in PROFILE_STAGES if name in profile['stages']}}
+	for record in [report['total'], *report['stages'].values()]:
+		record.update((key, round(value, 4)) for key, value in record.items() if isinstance(value, float))
+	if profile['dump_stage']:
+		suffix = ".prof" if profile['dump'] == 'cprofile' else ".tracemalloc.txt"
+		report['dump'] = profile['out_prefix']+"_profile_"+profile['dump_stage']+suffix
+	with open(report_file, "w") as fh:
+		json.dump(report, fh, indent=1)
 
 parser = argparse.ArgumentParser(prog='rpkm_heater',\
 formatter_class=argparse.RawDescriptionHelpFormatter,\
@@ -54,34 +1431,50 @@ parser.add_argument('-read', '--read', help="Show Read.me", action="store_true")
 parser.add_argument('-dep', '--dependencies', help="List the program dependencies for endopep_peaks", action="store_true")
 parser.add_argument('-sort_format', '--sort_format', help="Print a formatting example of sorted_format options", action="store_true")
 parser.add_argument('-phy_col_format', '--phy_col_format', help="Print a formatting example of phylo_colors option", action='store_true')
+parser.add_argument('-batch_format', '--batch_format', help="Print a formatting example of the -batch manifest", action='store_true')
 subcommands.add_argument('-count', '--count' ,help="only run count", action="store_true")
 subcommands.add_argument('-map', '--map', help="count and heatmap", action="store_true")
-inputs.add_argument('-i', help="Specify input directory (idxstats) (_suffix = .stats)")
+subcommands.add_argument('-batch', '--batch', help="run every project in a TSV/JSON manifest, -jobs projects in parallel (see -batch_format)")
+subcommands.add_argument('-update', '--update', help="add new/changed samples in -i to an existing -o/-project, then heatmap", action="store_true")
+inputs.add_argument('-i', help="Specify input directory (idxstats, _suffix = .stats[.gz/.bz2/.zst] or tar bundles of them, or indexed BAMs, _suffix = .bam + .bai/.csi)")
 outputs.add_argument('-o', help="Specify output directory (will be created if no path) (see --clear_all)")
 outputs.add_argument('-project', help="name of rpkm project")
-heatmap.add_argument('-sort_samples', help="input sorted list for samples")
-heatmap.add_argument('-sort_gen', help="input sorted list for genes/genomes")
-heatmap.add_argument('-colors', help="specify color gradient (plasma/viridis/blue/red/green) (default:plasma)")
+outputs.add_argument('-npy', help="also write the RPKM matrix as memory-mappable <project>_rpkm.npy (+ .rows.txt/.cols.txt labels)", action="store_true")
+outputs.add_argument('-npz', help="with -npy, write the matrix of a sparse project (-sparse_below) as a scipy.sparse <project>_rpkm.npz instead (smaller, loaded whole)", action="store_true")
+heatmap.add_argument('-sort_samples', help="input sorted list for samples, or auto (clustering order of the log RPKM)")
+heatmap.add_argument('-sort_gen', help="input sorted list for genes/genomes, or auto (clustering order of the log RPKM)")
+heatmap.add_argument('-linkage', choices=LINKAGE_METHODS, default='average', help="hierarchical clustering method for auto sorting (default:average)")
+heatmap.add_argument('-olo', help="auto sorting: optimal leaf ordering of the clustering tree (seriation; slow beyond a few thousand genomes, cached)", action="store_true")
+heatmap.add_argument('-colors', help="specify color gradient (plasma/viridis/blue/red/green) or a palette file, one colour per line low-->high (default:plasma)")
 heatmap.add_argument('-phylo_colors', help="input color list for clades/sub-clades")
-heatmap.add_argument('-xticks', help="control xticks (on/off) (default:on)")
-heatmap.add_argument('-yticks', help="control yticks (on/off) (default:on)")
+heatmap.add_argument('-phylo_strip', help="draw -phylo_colors as a clade colour strip beside the rows instead of colouring each label", action="store_true")
+heatmap.add_argument('-renderer', choices=['raster', 'pcolor'], default='raster', help="heatmap drawing: raster image (fast) or v1.1 per-cell polygons (default:raster)")
+heatmap.add_argument('-xticks', default='on', help="control xticks (on/off) (default:on)")
+heatmap.add_argument('-yticks', default='on', help="control yticks (on/off) (default:on)")
+heatmap.add_argument('-tiles', help="write a zoomable tile pyramid + HTML viewer (<project>_<norm>_tiles/index.html) instead of one PNG", action="store_true")
+heatmap.add_argument('-dpi', type=int, default=900, help="heatmap resolution (default:900)")
+optional.add_argument('-jobs', '--jobs', type=int, default=1, help="parallel workers for reading idxstats files, rendering -tiles and -batch projects (default:1)")
+optional.add_argument('-no_cache', '--no_cache', help="always re-parse the idxstats files (ignore/skip <project>_counts.npz)", action="store_true")
+optional.add_argument('-chunk_size', '--chunk_size', type=int, help="-count only: stream N samples at a time and write the CSVs from disk (bounded memory, no cache)")
+optional.add_argument('-max_memory', '--max_memory', type=float, help="-count only: like -chunk_size, with N derived from a memory budget in MB")
+optional.add_argument('-norm', '--norm', help="comma separated units to write/draw, any of rpkm,tpm,cpm,coverage (default:rpkm)")
+optional.add_argument('-transform', '--transform', choices=TRANSFORMS, help="value transform (default: log10 for -map/-update, none for -count)")
+optional.add_argument('-with_unmapped', '--with_unmapped', help="count reads_unmapped into each sample's library size (rpkm/cpm)", action="store_true")
+optional.add_argument('-read_length', '--read_length', type=int, default=150, help="read length in bp for -norm coverage (default:150)")
+optional.add_argument('-group', '--group', help="aggregate samples into groups: a sample<tab>group file, or a regex on the sample name (first capture group), e.g. '^([A-Z]+)_'")
+optional.add_argument('-group_stat', '--group_stat', default='mean', help="comma separated group summaries, any of mean,median,prevalence (default:mean)")
+optional.add_argument('-sparse_below', '--sparse_below', type=float, default=SPARSE_DENSITY, help="keep counts/RPKM as sparse matrices when fewer than this fraction of genome x sample cells have reads (0: never) (default:%s)" % SPARSE_DENSITY)
+optional.add_argument('-watch', '--watch', type=float, nargs='?', const=0.5, metavar='SECONDS', help="keep running after -count/-map/-update: poll -i every SECONDS (default:0.5), fold new/changed samples into the in-memory project and redraw")
+optional.add_argument('-debounce', '--debounce', type=float, default=0.5, help="-watch waits until -i has stayed unchanged this many seconds before updating (default:0.5)")
+optional.add_argument('-profile', '--profile', help="write wall/CPU time and peak RSS per stage (parse, assemble, normalize, sort, render, write) to <project>_profile.json", action="store_true")
+optional.add_argument('-profile_stage', '--profile_stage', choices=PROFILE_STAGES, help="also dump a cProfile/tracemalloc profile of this stage (<project>_profile_<stage>.prof/.tracemalloc.txt), implies -profile")
+optional.add_argument('-profile_dump', '--profile_dump', choices=['cprofile', 'tracemalloc'], default='cprofile', help="-profile_stage profiler (default:cprofile)")
+optional.add_argument('-float32', '--float32', help="compute the RPKM matrix in single precision (halves its memory)", action="store_true")
 optional.add_argument('-clear', '--clear_all', help="clear previous output directory specification and data products (use if double-backing out_dir)", action="store_true")
 parser._optionals.title="## help arguments"
-args = parser.parse_args()
-
-####################
-# renavigate to -h #
-####################
-
-if len(sys.argv[1:]) == 0:
-	parser.print_help()
-	parser.exit()
-else:
-    pass
 
-if args.sort_format:
-	print(textwrap.dedent('''\
-    # Sorted_list should contain one line of sample prefixes by tab "\t" #
+SORT_FORMAT_EXAMPLE = textwrap.dedent('''\
+    # Sorted_list should contain one line of sample prefixes by tab "\t" (or one prefix per line) #
 
     # i.e. ANE_004_05M.bam.stats, ANE_150_40M.bam.stats -->
 
@@ -89,759 +1482,423 @@ if args.sort_format:
 
 Full_example:
 ANE_004_05M	ANE_150_05M	ANE_151_05M	ANE_152_05M	ANW_141_05M	ANW_142_05M	ANW_145_05M	ANW_146_05M	ANW_148_05M	ANW_149_05M	ASE_66_05M	ASE_67_05M	ASE_68_05M	ASE_70_05M	ASW_72_05M	ASW_76_05M	ASW_78_05M	ASW_82_05M	ION_36_05M	ION_38_05M	ION_41_05M	ION_42_05M	ION_45_05M	ION_48_05M	IOS_52_05M	IOS_56_05M	IOS_57_05M	IOS_62_05M	IOS_64_05M	IOS_65_05M	MED_18_05M	MED_23_05M	MED_25_05M	MED_30_05M	PON_132_05M	PON_133_05M	PON_137_05M	PON_138_05M	PON_140_05M	PSE_100_05M	PSE_102_05M	PSE_109_05M	PSE_110_05M	PSE_111_05M	PSE_93_05M	PSE_94_05M	PSE_96_05M	PSE_98_05M	PSE_99_05M	PSW_112_05M	PSW_122_05M	PSW_123_05M	PSW_124_05M	PSW_125_05M	PSW_128_05M	RED_31_05M	RED_32_05M	RED_33_05M	RED_34_05M	SOC_84_05M	SOC_85_05M	ION_36_17M	ION_38_25M	ION_39_25M	ASE_66_30M	IOS_65_30M	PSE_109_30M	PSE_93_35M	ANE_004_40M	ANE_150_40M	ASW_82_40M	PON_137_40M	PSE_102_40M	PSW_128_40M	PON_133_45M	ASE_68_50M	MED_25_50M	PSE_100_50M	PSE_110_50M	ION_41_60M	MED_18_60M	PON_138_60M	RED_34_60M	IOS_64_65M	IOS_58_66M	MED_30_70M	IOS_52_75M	ANE_151_80M	ION_42_80M	RED_32_80M	PSE_111_90M	SOC_85_90M	ASW_72_100M
-'''))
-	exit()
-else:
-	pass
-
-if args.phy_col_format:
-	print(textwrap.dedent('''\
-	# phylo_colors should contain 3 columns "\t" #
-    1. Genome
-    2. Order (index starts at 0)
-    3. Color (CAn be hexidecimal or standard)
-
-    # i.e. 2503754001	1	#990000
-
-Snippet_example:
-2503754001	0	#990000
-2706794856	1	blue
-2236347020	2	green
-    '''))
-	exit()
-else:
-	pass
-
-if args.read:
-	subprocess.call("cat ~/rpkm_heater/Read.ME", shell=True)
-	exit()
-else:
-	pass
-
-input_folder = args.i
-project_name = args.project
-path=args.i
-allFiles = glob.glob(path + "/*.stats")
-
-if args.clear_all:
-	subprocess.call("rm -rf "+args.o+"; mkdir "+args.o, shell=True)
-	subprocess.call("chmod 777 "+args.o, shell=True)
-else:
-	subprocess.call("mkdir "+args.o, shell=True)
-	subprocess.call("chmod 777 "+args.o, shell=True)
-
-#Appending *.stats to df#
-list = []
-#Appending metG sample name for use throughout pipes#
-sample_list = []
-#Appending ACC#
-acc_list = []
-#Appending _totreads to intermediates#
-counts_list = []
-
-
-
-if args.count:
-	for file_ in allFiles:
-		samples = os.path.basename(file_)
-		samples_1 = os.path.splitext(samples)[0]
-		samples_2 = os.path.splitext(samples_1)[0]
-		sample_list.append(samples_2)
-		df = pd.read_csv(file_, index_col=None, dtype=str, header=None, sep="\t").assign(filename=samples_2)
-		df.columns = ['ACC','genome_length','reads_mapped','reads_unmapped','sample']
-		df1 = df[['ACC','genome_length','reads_mapped','sample']]
-		df1.set_index('ACC', inplace=True)
-
-		gen_length_key = df1[['genome_length']]
-		gen_length_key.to_csv('temp1.csv', sep="\t")
-
-		df2 = df1[['reads_mapped','sample']]
-
-		print(df2)
-		list.append(df2)
-	frame2 = pd.concat(list, axis=1, ignore_index=True)
-	print(frame2)
-	frame2.to_csv(args.o+"/"+project_name+'_frame2.csv', sep="\t")
-	gen_length_key = pd.read_csv("temp1.csv", sep="\t")
-	gen_length_key.columns = ['ACC','genome_length']
-	gen_length_key.set_index('ACC', inplace=True)
-	acc_list.append(gen_length_key.index.values)
-	frame3 = pd.concat([gen_length_key,frame2], axis=1, join_axes=[gen_length_key.index])
-	print(frame3)
-#	frame3.to_csv(args.o+"/"+project_name+'_frame3.csv', sep="\t")
-
-	frame4 = frame3.iloc[0:,1::2]
-	print(frame4)
-#	frame4.to_csv(args.o+"/"+project_name+'_frame4.csv', sep="\t")
-	gen_length_key = pd.read_csv("temp1.csv", sep="\t")
-	gen_length_key.columns = ['ACC','genome_length']
-	gen_length_key.set_index('ACC', inplace=True)
-
-	counts = pd.concat([gen_length_key,frame4], axis=1, join_axes=[gen_length_key.index])
-	print(counts)
-	subprocess.call("rm -f temp1.csv", shell=True)
-
-	print(sample_list)
-	counts.columns = counts.columns[:1].tolist() + sample_list
-	print(counts)
-
-	counts.drop(counts.tail(1).index,inplace=True)
-	counts.to_csv(args.o+"/"+project_name+'_counts.csv', sep="\t")
-
-	counts = counts.convert_objects(convert_numeric=True)
-	counts.loc['Total',:] = counts.sum(axis=0) / 1000000
-	print(counts)
-	print(counts.dtypes)
-
-	counts['genome_length']['Total'] = 0
-	counts_list.append(counts.loc['Total'])
-	counts['genome_length'] = counts['genome_length'] / 1000
-	counts = counts.add_suffix('_reads')
-	counts=counts.rename(columns = {'genome_length_reads':'genome_length'})
-	print(counts)
-	print(counts_list)
-
-	df_test = pd.DataFrame(counts_list)
-	df_test.drop('genome_length', axis=1, inplace=True)
-	df_test = df_test.add_suffix('_totreads')
-	print(df_test)
-
-	try1 = pd.concat([df_test,counts], axis=1, join_axes=[counts.index])
-	try1=  try1.sort_values(by=['genome_length'], ascending=[True])
-
-	stacker = try1.stack()
-	try1 = stacker.unstack()
-	try1 = try1.reindex(sorted(try1.columns), axis=1)
-	first_col = try1.pop('genome_length')
-	try1.insert(0, 'genome_length', first_col)
-	try1.fillna(method='ffill', inplace=True)
-	try1 = try1.iloc[1:]
-	print(try1)
-
-	# RPKM, top = numReads#
-	df_top = try1.iloc[0:,1::2]
-
-	# RPKM, bottom = (gen_l/100)(totReads/1000000)#
-	df_bottom = try1.iloc[0:,0::2]
-	#print(df_top)
-	#print(df_bottom)
-	df_bottom.memory_usage(deep=True)
-
-	#RPKM, bottom --> gl*tR#
-	#print(df_bottom.iloc[0:,1::1])
-	df_bottom_2 = df_bottom.iloc[0:,1::1].multiply(df_bottom["genome_length"], axis="index")
-	#print(df_bottom_2)
-
-
-	#RPKM, top/bottom#
-	#print(df_top.iloc[0:,0::1])
-	df_rpkm = df_top.iloc[0:,0::1].divide(df_bottom_2.values, axis="index")
-	df_rpkm.columns = df_rpkm.columns.str.replace('_reads', '', regex=True)
-	print(df_rpkm)
+''')
+
+PHYLO_FORMAT_EXAMPLE = textwrap.dedent('''\
+        # phylo_colors should contain 3 columns "\t" #
+        1. Genome (labels are coloured by this id, wherever -sort_gen puts it)
+        2. Order (index starts at 0, only used when no Genome id is on the heatmap)
+        3. Color (CAn be hexidecimal or standard)
+
+        # i.e. 2503754001	1	#990000
+
+    Snippet_example:
+    2503754001	0	#990000
+    2706794856	1	blue
+    2236347020	2	green
+''')
+
+#########
+# batch #
+#########
+
+BATCH_FORMAT_EXAMPLE = textwrap.dedent("""\
+        # -batch manifest: one project per row (TSV with a header) or per object (JSON list) #
+        # keys are the command line options without "-"; mode = count/map (default) /update #
+        # flags (npy, tiles, float32, ...) take true/false; -o of the -batch call is the default o #
+
+    TSV_example:
+    mode	i	project	sort_samples	colors
+    map	test	ocean	sorted_list_examples/sort_sample_list.txt	plasma
+    count	test2	coast
+
+    JSON_example:
+    [{"i": "test", "project": "ocean", "colors": "viridis", "tiles": true},
+     {"mode": "count", "i": "test2", "project": "coast", "o": "counts_only"}]
+""")
+
+def read_manifest(manifest):
+	# TSV (header row) or JSON (list of objects, or {"projects": [...]}) --> list of {option: value} #
+	with open(manifest, "r") as fh:
+		if manifest.endswith(".json"):
+			specs = json.load(fh)
+			specs = specs.get('projects', []) if isinstance(specs, dict) else specs
+		else:
+			lines = [line.rstrip("\n").split("\t") for line in fh if line.strip() and not line.startswith("#")]
+			specs = [dict((key, value) for key, value in zip(lines[0], row) if value != "") for row in lines[1:]]
+	return specs
+
+def spec_argv(spec, out_dir=None):
+	# one manifest entry --> the argv of the equivalent single rpkm_heater run #
+	spec = dict(spec)
+	mode = spec.pop('mode', 'map')
+	if mode not in ('count', 'map', 'update'):
+		raise ValueError("batch mode must be count/map/update, not "+str(mode))
+	if out_dir and not spec.get('o'):
+		spec['o'] = out_dir
+	for required in ('i', 'o', 'project'):
+		if not spec.get(required):
+			raise ValueError("batch entry "+json.dumps(spec)+" has no "+required)
+	argv = ['-'+mode]
+	for key, value in spec.items():
+		action = parser._option_string_actions.get('-'+key)
+		if action is None or key in ('count', 'map', 'update', 'batch'):
+			raise ValueError("batch entry "+str(spec.get('project'))+": unknown option "+key)
+		if action.dest == 'clear_all':
+			# the project's _batch.log is open inside -o while it runs #
+			raise ValueError("batch entry "+str(spec.get('project'))+": clear is not allowed in a manifest")
+		if action.nargs == 0:
+			if str(value).lower() in ('true', 'yes', '1'):
+				argv.append('-'+key)
+		elif value is not None:
+			argv += ['-'+key, str(value)]
+	return argv
+
+def run_spec(argv):
+	# worker: run one project in this process, its console output going to <o>/<project>_batch.log #
+	# (spec_argv() always puts -o and -project in, so the log can be opened before the options are parsed) #
+	out_dir = argv[argv.index('-o') + 1]
+	project = argv[argv.index('-project') + 1]
+	os.makedirs(out_dir, exist_ok=True)
+	start = time.time()
+	with open(os.path.join(out_dir, project+"_batch.log"), "w") as log, contextlib.redirect_stdout(log), contextlib.redirect_stderr(log):
+		try:
+			# a bad option value (argparse exits with 2, message in the log) fails this project only #
+			parser.parse_args(argv)
+		except SystemExit:
+			return project, "failed: invalid option value (see "+project+"_batch.log)", time.time() - start
+		try:
+			main(argv)
+			status = "ok"
+		except SystemExit as err:
+			status = "ok" if err.code in (None, 0) else "failed: "+str(err.code)
+		except Exception as err:
+			status = "failed: "+repr(err)
+	return project, status, time.time() - start
+
+def run_batch(manifest, out_dir=None, jobs=1):
+	# every manifest entry as its own rpkm_heater run, `jobs` projects at a time in separate processes #
+	runs = [spec_argv(spec, out_dir) for spec in read_manifest(manifest)]
+	if jobs > 1 and len(runs) > 1:
+		with ProcessPoolExecutor(max_workers=jobs) as pool:
+			return list(pool.map(run_spec, runs))
+	return [run_spec(argv) for argv in runs]
 
-	#df_rpkm.to_csv(project_name+"_rpkm.csv", sep="\t")
-
-	#print(acc_list)
-
-	if args.sort_samples and args.sort_gen:
-		sorted = pd.read_csv(args.sort_samples, sep="\t")
-		print(sorted)
-		sorted_list = sorted.columns.tolist()
-		print(sorted_list)
-
-		df_rpkm = df_rpkm[sorted_list]
-
-		sorted_y = pd.read_csv(args.sort_gen, sep="\t")
-		print(sorted_y)
-		sorted_list_y = sorted_y.columns.tolist()
-		print(sorted_list_y)
-
-		df_rpkm = df_rpkm.reindex(sorted_list_y)
-		df_rpkm = df_rpkm.T
-		print(df_rpkm)
-		df_rpkm.to_csv(args.o+"/"+project_name+"_rpkm.csv", sep="\t")
-
-	elif args.sort_samples:
-		sorted = pd.read_csv(args.sort_samples, sep="\t")
-		print(sorted)
-		sorted_list = sorted.columns.tolist()
-		print(sorted_list)
-
-		df_rpkm = df_rpkm[sorted_list]
-		print(df_rpkm)
-		df_rpkm.to_csv(args.o+"/"+project_name+"_rpkm.csv", sep="\t")
-
-	elif args.sort_gen:
-		sorted = pd.read_csv(args.sort_samples, sep="\t")
-		print(sorted)
-		sorted_list = sorted.columns.tolist()
-		print(sorted_list)
-
-		df_rpkm = df_rpkm[sorted_list]
-		print(df_rpkm)
-		df_rpkm.to_csv(args.o+"/"+project_name+"_rpkm.csv", sep="\t")
-
-
-elif args.map:
-	for file_ in allFiles:
-		samples = os.path.basename(file_)
-		samples_1 = os.path.splitext(samples)[0]
-		samples_2 = os.path.splitext(samples_1)[0]
-		sample_list.append(samples_2)
-		df = pd.read_csv(file_, index_col=None, dtype=str, header=None, sep="\t").assign(filename=samples_2)
-		df.columns = ['ACC','genome_length','reads_mapped','reads_unmapped','sample']
-		df1 = df[['ACC','genome_length','reads_mapped','sample']]
-		df1.set_index('ACC', inplace=True)
-
-		gen_length_key = df1[['genome_length']]
-		gen_length_key.to_csv('temp1.csv', sep="\t")
-
-		df2 = df1[['reads_mapped','sample']]
-
-		#print(df2)
-		list.append(df2)
-	frame2 = pd.concat(list, axis=1, ignore_index=True)
-	print(frame2)
-#	frame2.to_csv(args.o+"/"+project_name+'_frame2.csv', sep="\t")
-
-	gen_length_key = pd.read_csv("temp1.csv", sep="\t")
-	gen_length_key.columns = ['ACC','genome_length']
-	gen_length_key.set_index('ACC', inplace=True)
-	acc_list.append(gen_length_key.index.values)
-	frame3 = pd.concat([gen_length_key,frame2], axis=1, join_axes=[gen_length_key.index])
-	print(frame3)
-#	frame3.to_csv(args.o+"/"+project_name+'_frame3.csv', sep="\t")
-
-
-	frame4 = frame3.iloc[0:,1::2]
-	print(frame4)
-#	frame4.to_csv(args.o+"/"+project_name+'_frame4.csv', sep="\t")
-
-	gen_length_key = pd.read_csv("temp1.csv", sep="\t")
-	gen_length_key.columns = ['ACC','genome_length']
-	gen_length_key.set_index('ACC', inplace=True)
-
-	counts = pd.concat([gen_length_key,frame4], axis=1, join_axes=[gen_length_key.index])
-	print(counts)
-	subprocess.call("rm -f temp1.csv", shell=True)
+####################
+# renavigate to -h #
+####################
 
-	print(sample_list)
-	counts.columns = counts.columns[:1].tolist() + sample_list
+def main(argv=None):
+	argv = sys.argv[1:] if argv is None else argv
+	os.environ.setdefault('MPLBACKEND', 'Agg')
+	if len(argv) == 0:
+		parser.print_help()
+		parser.exit()
+	args = parser.parse_args(argv)
+
+	if args.sort_format:
+		print(SORT_FORMAT_EXAMPLE)
+		return
+
+	if args.phy_col_format:
+		print(PHYLO_FORMAT_EXAMPLE)
+		return
+
+	if args.batch_format:
+		print(BATCH_FORMAT_EXAMPLE)
+		return
+
+	if args.read:
+		subprocess.call("cat ~/rpkm_heater/Read.ME", shell=True)
+		return
+
+	if args.batch:
+		try:
+			results = run_batch(args.batch, out_dir=args.o, jobs=args.jobs)
+		except (ValueError, OSError) as err:
+			sys.exit(str(err))
+		for project, status, seconds in results:
+			print("## "+project+": "+status+" (%.1fs)" % seconds)
+		if any(status != "ok" for project, status, seconds in results):
+			sys.exit("## batch: "+str(sum(status != "ok" for project, status, seconds in results))+" project(s) failed, see <o>/<project>_batch.log")
+		return
+
+	if args.float32:
+		rpkm_dtype = np.float32
+	else:
+		rpkm_dtype = np.float64
+	norms = [*dict.fromkeys(args.norm.split(","))] if args.norm else ['rpkm']
+	if any(norm not in NORMS for norm in norms):
+		sys.exit("-norm takes a comma separated list of "+"/".join(NORMS))
+	group_stats = [*dict.fromkeys(args.group_stat.split(","))]
+	if any(stat not in GROUP_STATS for stat in group_stats):
+		sys.exit("-group_stat takes a comma separated list of "+"/".join(GROUP_STATS))
+
+	out_prefix = args.o+"/"+args.project
+
+	if args.clear_all:
+		shutil.rmtree(args.o, ignore_errors=True)
+	os.makedirs(args.o, exist_ok=True)
+	os.chmod(args.o, 0o777)
+
+	profile = new_profile(args.profile_stage, args.profile_dump, out_prefix) if args.profile or args.profile_stage else None
+	try:
+		run_project(args, norms, group_stats, rpkm_dtype, profile=profile)
+	finally:
+		if profile is not None:
+			write_profile(profile, out_prefix+"_profile.json", argv)
+			print("## stage profile written to "+out_prefix+"_profile.json")
+
+def run_project(args, norms, group_stats, rpkm_dtype, profile=None):
+	# the -count/-map/-update pipeline for one -i/-o/-project; stage() records each step when profiling #
+	project_name = args.project
+	out_prefix = args.o+"/"+project_name
+	try:
+		allFiles = input_files(args.i)
+	except ValueError as err:
+		sys.exit(str(err))
+
+	# parsed once up front (a bad file fails before the counts are read) and looked up by genome id at render time #
+	phylo = None
+	try:
+		if args.phylo_colors and not args.count and not args.tiles:
+			phylo = read_phylo_colors(args.phylo_colors)
+		if not args.count:
+			# an unknown -colors fails here rather than after the tables are written #
+			get_colormap(args.colors)
+		if args.dpi < 1:
+			raise ValueError("-dpi must be at least 1")
+	except ValueError as err:
+		sys.exit(str(err))
+
+	if args.chunk_size or args.max_memory:
+		if not args.count:
+			sys.exit("-chunk_size/-max_memory stream -count only (no heatmap)")
+		if 'auto' in (args.sort_samples, args.sort_gen):
+			sys.exit("-sort_samples/-sort_gen auto need the whole matrix in memory (no -chunk_size/-max_memory)")
+		if len(norms) > 1 or args.transform not in (None, 'none') or args.group:
+			sys.exit("-chunk_size/-max_memory write one untransformed, ungrouped -norm")
+		if args.watch is not None:
+			sys.exit("-watch keeps the matrix in memory (no -chunk_size/-max_memory)")
+		sort_samples = read_sort_list(args.sort_samples) if args.sort_samples else None
+		sort_gen = read_sort_list(args.sort_gen) if args.sort_gen else None
+		try:
+			# parse, normalize and write interleave chunk by chunk, so streaming is profiled as one stage #
+			with stage(profile, 'stream'):
+				stream_rpkm(allFiles, out_prefix, chunk_size=args.chunk_size, max_memory=args.max_memory, jobs=args.jobs,
+					dtype=rpkm_dtype, sample_order=sort_samples, genome_order=sort_gen, npy=args.npy,
+					norm=norms[0], unmapped=args.with_unmapped, read_length=args.read_length,
+					table=bool(args.sort_samples or args.sort_gen or args.norm or args.transform or args.npy),
+					transpose=bool(args.sort_samples and args.sort_gen))
+		except ValueError as err:
+			sys.exit(str(err))
+		return
+
+	if not (args.count or args.map or args.update):
+		if args.watch is not None:
+			sys.exit("-watch keeps a -count/-map/-update project up to date, give one of them")
+		return
+
+	cache_file = out_prefix+"_counts.npz"
+	fingerprint = stats_fingerprint(allFiles)
+	try:
+		cache = None
+		if not args.no_cache:
+			with stage(profile, 'parse'):
+				cache = load_cache(cache_file)
+		if args.update:
+			if cache is None:
+				sys.exit("-update needs an existing project in "+args.o+" (run -count or -map first)")
+			# update_project parses and folds in the new files in one go #
+			with stage(profile, 'parse'):
+				fingerprint, counts, rpkm, unmapped, new_samples, dropped = update_project(*cache, allFiles, jobs=args.jobs)
+			print("## new/updated samples: "+str(new_samples))
+			layout = isinstance(counts, SparseFrame)
+			counts, rpkm = with_layout(counts, rpkm, args.sparse_below)
+			if fingerprint != cache[0] or isinstance(counts, SparseFrame) != layout:
+				with stage(profile, 'write'):
+					save_cache(cache_file, fingerprint, counts, rpkm, unmapped)
+					write_counts(counts, out_prefix, frame2=args.count)
+		elif cache is not None and cache[0] == fingerprint:
+			print("## reusing parsed counts from "+cache_file)
+			fingerprint, counts, rpkm, unmapped = cache
+			layout = isinstance(counts, SparseFrame)
+			counts, rpkm = with_layout(counts, rpkm, args.sparse_below)
+			if isinstance(counts, SparseFrame) != layout:
+				print("## -sparse_below: project converted to "+("sparse" if isinstance(counts, SparseFrame) else "dense")+" matrices")
+				with stage(profile, 'write'):
+					save_cache(cache_file, fingerprint, counts, rpkm, unmapped)
+			if args.count and not os.path.exists(out_prefix+'_frame2.csv'):
+				write_frame2(counts, out_prefix)
+		else:
+			with stage(profile, 'parse'):
+				stats = load_stats(allFiles, jobs=args.jobs)
+			with stage(profile, 'assemble'):
+				counts = build_counts(genome_length_key(stats), stats, sparse_below=args.sparse_below)
+				unmapped = unmapped_totals(stats)
+				del stats
+			with stage(profile, 'normalize'):
+				rpkm = counts_rpkm(counts, dtype=rpkm_dtype)
+			with stage(profile, 'write'):
+				if not args.no_cache:
+					save_cache(cache_file, fingerprint, counts, rpkm, unmapped)
+				write_counts(counts, out_prefix, frame2=args.count)
+	except ValueError as err:
+		sys.exit(str(err))
+	del cache
+	try:
+		render_project(args, counts, rpkm, unmapped, norms, group_stats, rpkm_dtype, phylo, profile)
+	except ValueError as err:
+		sys.exit(str(err))
+	if args.watch is None:
+		return
+
+	# -watch: the project stays in memory, settled changes of -i are folded in and the outputs redrawn #
+	print("## watching "+args.i+" every "+str(args.watch)+"s (Ctrl-C stops)")
+	# only samples whose file is seen leaving -i are dropped, not those of a project -update'd from new files only #
+	watched = {os.path.abspath(file_) for file_ in allFiles}
+	try:
+		for files in watch_inputs(args.i, fingerprint, interval=args.watch, debounce=args.debounce):
+			start = time.perf_counter()
+			try:
+				with stage(profile, 'parse'):
+					fingerprint, counts, rpkm, unmapped, new_samples, dropped = update_project(fingerprint, counts, rpkm, unmapped, files, jobs=args.jobs, watched=watched)
+			except ValueError as err:
+				print("## -watch: "+str(err)+" (waiting for the next change)")
+				continue
+			watched.update(os.path.abspath(file_) for file_ in files)
+			if not (new_samples or dropped):
+				continue
+			with stage(profile, 'write'):
+				if not args.no_cache:
+					save_cache(cache_file, fingerprint, counts, rpkm, unmapped)
+				write_counts(counts, out_prefix, frame2=args.count)
+			if new_samples:
+				print("## new/updated samples: "+str(new_samples)+" folded in (%.2fs)" % (time.perf_counter() - start))
+			if dropped:
+				print("## samples whose input file is gone, dropped: "+str(dropped))
+			try:
+				render_project(args, counts, rpkm, unmapped, norms, group_stats, rpkm_dtype, phylo, profile)
+			except (ValueError, OSError) as err:
+				# e.g. a -sort_samples/-group list that no longer matches (or was moved); the next change redraws again #
+				print("## -watch: "+str(err)+" (waiting for the next change)")
+				continue
+			print("## outputs refreshed %.2fs after the change settled" % (time.perf_counter() - start))
+	except KeyboardInterrupt:
+		print("## watch stopped")
+
+def watch_inputs(directory, fingerprint, interval=0.5, debounce=0.5):
+	# poll -i (stat only) and yield its input files once a change has settled, i.e. nothing changed for debounce #
+	# seconds, so a burst of arrivals or a file still being copied becomes one update #
+	def snapshot():
+		try:
+			files = input_files(directory)
+			return files, {tuple(entry) for entry in stats_fingerprint(files)}
+		except (ValueError, OSError):
+			# e.g. a BAM whose index has not arrived yet, or a file renamed between glob and stat #
+			return None, None
+	seen = {tuple(entry) for entry in fingerprint}
+	while True:
+		time.sleep(interval)
+		files, current = snapshot()
+		if current is None or current == seen:
+			continue
+		while True:
+			time.sleep(debounce)
+			files, settled = snapshot()
+			if settled == current:
+				break
+			current = settled
+		if files is None:
+			continue
+		seen = current
+		yield files
+
+def render_project(args, counts, rpkm, unmapped, norms, group_stats, rpkm_dtype, phylo=None, profile=None):
+	# everything after the counts: -norm frames, sort/cluster, -group, then the tables and heatmaps/tiles #
+	# (a bad list or setting raises ValueError, -watch keeps running on it) #
+	project_name = args.project
+	out_prefix = args.o+"/"+project_name
+	if profile is not None:
+		profile['matrix'] = {'genomes': counts.shape[0], 'samples': len(counts_samples(counts)), 'sparse': isinstance(counts, SparseFrame)}
+	with stage(profile, 'normalize'):
+		if rpkm.dtype != rpkm_dtype:
+			rpkm = counts_rpkm(counts, dtype=rpkm_dtype)
+	print(counts_samples(counts).tolist())
 	print(counts)
 
-	counts.drop(counts.tail(1).index,inplace=True)
-	counts.to_csv(args.o+"/"+project_name+'_counts.csv', sep="\t")
+	def norm_frame(norm):
+		# every -norm comes from the same in-memory counts; plain RPKM is already cached #
+		with stage(profile, 'normalize'):
+			if norm == 'rpkm' and not args.with_unmapped:
+				return rpkm_frame(counts, rpkm)
+			return rpkm_frame(counts, normalize(counts, norm, unmapped if args.with_unmapped else None, dtype=rpkm_dtype, read_length=args.read_length))
 
-
-	counts = counts.convert_objects(convert_numeric=True)
-	counts.loc['Total',:] = counts.sum(axis=0) / 1000000
-	print(counts)
-	print(counts.dtypes)
-#	counts.to_csv(args.o+"/"+project_name+'1.csv', sep="\t")
-
-	counts['genome_length']['Total'] = 0
-	counts_list.append(counts.loc['Total'])
-	counts['genome_length'] = counts['genome_length'] / 1000
-	counts = counts.add_suffix('_reads')
-	counts=counts.rename(columns = {'genome_length_reads':'genome_length'})
-	print(counts)
-	print(counts_list)
-#	counts.to_csv(args.o+"/"+project_name+'2.csv', sep="\t")
-
-	df_test = pd.DataFrame(counts_list)
-	df_test.drop('genome_length', axis=1, inplace=True)
-	df_test = df_test.add_suffix('_totreads')
-	print(df_test)
-#	df_test.to_csv(args.o+"/"+project_name+'3.csv', sep="\t")
-
-	try1 = pd.concat([df_test,counts], axis=1, join_axes=[counts.index])
-	try1=  try1.sort_values(by=['genome_length'], ascending=[True])
-
-	stacker = try1.stack()
-	try1 = stacker.unstack()
-	try1 = try1.reindex(sorted(try1.columns), axis=1)
-	first_col = try1.pop('genome_length')
-	try1.insert(0, 'genome_length', first_col)
-	try1.fillna(method='ffill', inplace=True)
-	try1 = try1.iloc[1:]
-	print(try1)
-#	try1.to_csv(args.o+"/"+project_name+'4.csv', sep="\t")
-
-	# RPKM, top = numReads#
-	df_top = try1.iloc[0:,1::2]
-
-	# RPKM, bottom = (gen_l/100)(totReads/1000000)#
-	df_bottom = try1.iloc[0:,0::2]
-	print(df_top)
-	print(df_bottom)
-	df_bottom.memory_usage(deep=True)
-
-	#RPKM, bottom --> gl*tR#
-	#print(df_bottom.iloc[0:,1::1])
-	df_bottom_2 = df_bottom.iloc[0:,1::1].multiply(df_bottom["genome_length"], axis="index")
-	print(df_bottom_2)
-
-
-	#RPKM, top/bottom#
-	#print(df_top.iloc[0:,0::1])
-	df_rpkm = df_top.iloc[0:,0::1].divide(df_bottom_2.values, axis="index")
-	df_rpkm.columns = df_rpkm.columns.str.replace('_reads', '', regex=True)
+	df_rpkm = norm_frame(norms[0])
 	print(df_rpkm)
-	print(acc_list)
-
-	if args.sort_samples and args.sort_gen:
-		sorted = pd.read_csv(args.sort_samples, sep="\t")
-		print(sorted)
-		sorted_list = sorted.columns.tolist()
-		print(sorted_list)
-
-		df_rpkm = df_rpkm[sorted_list]
-
-		sorted_y = pd.read_csv(args.sort_gen, sep="\t")
-		print(sorted_y)
-		sorted_list_y = sorted_y.columns.tolist()
-		print(sorted_list_y)
-
-		df_rpkm = df_rpkm.reindex(sorted_list_y)
-#		df_rpkm = df_rpkm.T
-		print(df_rpkm)
-		df_rpkm = np.log10(df_rpkm)
-		df_rpkm[df_rpkm < 0] = 0
-		df_rpkm.to_csv(args.o+"/"+project_name+"_rpkm.csv", sep="\t")
-
-
-
-
-
-		#Heatmap sorted by Ocean and depth#
-		if args.colors:
-			if args.colors == 'plasma':
-				colormap_1 = LinearSegmentedColormap.from_list('colorbar', ['#FFFF99','#efe350ff','#f7cb44ff','#f9b641ff','#f9a242ff',\
-				'#f68f46ff','#eb8055ff','#de7065ff','#cc6a70ff','#b8627dff','#a65c85ff','#90548bff','#7e4e90ff','#6b4596ff','#593d9cff',\
-				'#403891ff','#253582ff','#13306dff','#0c2a50ff','#042333ff'], N=10000000)
-			elif args.colors == 'viridis':
-				colormap_1 = LinearSegmentedColormap.from_list('colorbar', ['#FFFF99','#DCE319FF','#B8DE29FF','#95D840FF','#73D055FF',\
-				'#55C667FF','#3CBB75FF','#29AF7FFF','#20A387FF','#1F968BFF','#238A8DFF','#287D8EFF','#2D708EFF','#33638DFF','#39568CFF',\
-				'#404788FF','#453781FF','#482677FF','#481567FF','#440154FF'], N=10000000)
-			elif args.colors == 'blue':
-				colormap_1 = LinearSegmentedColormap.from_list('colorbar', ['#99FFFF','#6699FF','#0000CC','#000099','#000066'], N=10000000)
-			elif args.colors == 'red':
-				colormap_1 = LinearSegmentedColormap.from_list('colorbar', ['#FFCCCC','#FF6666','#CC3333','#990000','#660000'], N=10000000)
-			elif args.colors == 'green':
-				colormap_1 = LinearSegmentedColormap.from_list('colorbar', ['#CCFFCC','#66CC66','#339933','#006600','#003300'], N=10000000)
-			leg_color = plt.pcolor(df_rpkm, cmap=colormap_1)
-			plt.yticks(np.arange(0.2, len(df_rpkm.index), 1), df_rpkm.index)
-			plt.xticks(np.arange(0.2, len(df_rpkm.columns), 1), df_rpkm.columns)
-			plt.xticks(fontsize=1.5, rotation=90)
-			if args.phylo_colors:
-				ord_list = []
-				color_phy_list = []
-				phylo = open(args.phylo_colors, "r")
-				for lines in phylo.readlines():
-					line = lines.rstrip()
-					tabs = line.split("\t")
-					ids = tabs[0]
-					ord = tabs[1]
-					color = tabs[2]
-					ord_list.append(ord)
-					ord_list = [int(i) for i in ord_list]
-					color_phy_list.append(color)
-					color_phy_list = [str(i) for i in color_phy_list]
-#                    print(ord_list)
-#                    print(color_phy_list)
-				for val,val2 in zip(ord_list,color_phy_list):
-					plt.gca().get_yticklabels()[val].set_color(val2)
-			else:
-				pass
-			if args.xticks == 'off':
-				plt.xticks([])
-			else:
-				pass
-			if args.yticks == 'off':
-				plt.yticks([])
-			else:
-				pass
-			plt.yticks(fontsize=0.0005)
-			plt.gca().invert_yaxis()
-			plt.tight_layout()
-			legend = plt.colorbar(leg_color)
-        #plt.show()
-			date = time.strftime("%m.%d.%Y")
-			plt.savefig(args.o+"/"+project_name+'_rpkm_heat_'+date+'.png',dpi=1100)
-		else:
-			colormap_1 = LinearSegmentedColormap.from_list('colorbar', ['#FFFF99','#efe350ff','#f7cb44ff','#f9b641ff','#f9a242ff',\
-			'#f68f46ff','#eb8055ff','#de7065ff','#cc6a70ff','#b8627dff','#a65c85ff','#90548bff','#7e4e90ff','#6b4596ff','#593d9cff',\
-			'#403891ff','#253582ff','#13306dff','#0c2a50ff','#042333ff'], N=10000000)
-			#norm = Normalize(vmin=min(df_rpkm),vmax=max(df_rpkm))
-			leg_color = plt.pcolor(df_rpkm, cmap=colormap_1)
-			plt.yticks(np.arange(0.2, len(df_rpkm.index), 1), df_rpkm.index)
-			plt.xticks(np.arange(0.2, len(df_rpkm.columns), 1), df_rpkm.columns)
-			plt.xticks(fontsize=1.5, rotation=90)
-			if args.phylo_colors:
-				ord_list = []
-				color_phy_list = []
-				phylo = open(args.phylo_colors, "r")
-				for lines in phylo.readlines():
-					line = lines.rstrip()
-					tabs = line.split("\t")
-					ids = tabs[0]
-					ord = tabs[1]
-					color = tabs[2]
-					ord_list.append(ord)
-					ord_list = [int(i) for i in ord_list]
-					color_phy_list.append(color)
-					color_phy_list = [str(i) for i in color_phy_list]
-#                    print(ord_list)
-#                    print(color_phy_list)
-				for val,val2 in zip(ord_list,color_phy_list):
-					plt.gca().get_xticklabels()[val].set_color(val2)
-			else:
-				pass
-			if args.xticks == 'off':
-				plt.xticks([])
-			else:
-				pass
-			if args.yticks == 'off':
-				plt.yticks([])
-			else:
-				pass
-			plt.yticks(fontsize=0.05)
-			plt.gca().invert_yaxis()
-			plt.tight_layout()
-			legend = plt.colorbar(leg_color)
-			#plt.show()
-			date = time.strftime("%m.%d.%Y")
-			plt.savefig(args.o+"/"+project_name+'_rpkm_heat_'+date+'.png',dpi=900)
-
-	elif args.sort_samples:
-		sorted = pd.read_csv(args.sort_samples, sep="\t")
-		print(sorted)
-		sorted_list = sorted.columns.tolist()
-		print(sorted_list)
-
-		df_rpkm = df_rpkm[sorted_list]
-		print(df_rpkm)
-		df_rpkm = np.log10(df_rpkm)
-		df_rpkm[df_rpkm < 0] = 0
-		df_rpkm.to_csv(args.o+"/"+project_name+"_rpkm.csv", sep="\t")
-
-
-		#Heatmap sorted by Ocean and depth#
-		if args.colors:
-			if args.colors == 'plasma':
-				colormap_1 = LinearSegmentedColormap.from_list('colorbar', ['#FFFF99','#efe350ff','#f7cb44ff','#f9b641ff','#f9a242ff',\
-				'#f68f46ff','#eb8055ff','#de7065ff','#cc6a70ff','#b8627dff','#a65c85ff','#90548bff','#7e4e90ff','#6b4596ff','#593d9cff',\
-				'#403891ff','#253582ff','#13306dff','#0c2a50ff','#042333ff'], N=10000000)
-			elif args.colors == 'viridis':
-				colormap_1 = LinearSegmentedColormap.from_list('colorbar', ['#FFFF99','#DCE319FF','#B8DE29FF','#95D840FF','#73D055FF',\
-				'#55C667FF','#3CBB75FF','#29AF7FFF','#20A387FF','#1F968BFF','#238A8DFF','#287D8EFF','#2D708EFF','#33638DFF','#39568CFF',\
-				'#404788FF','#453781FF','#482677FF','#481567FF','#440154FF'], N=10000000)
-			elif args.colors == 'blue':
-				colormap_1 = LinearSegmentedColormap.from_list('colorbar', ['#99FFFF','#6699FF','#0000CC','#000099','#000066'], N=10000000)
-			elif args.colors == 'red':
-				colormap_1 = LinearSegmentedColormap.from_list('colorbar', ['#FFCCCC','#FF6666','#CC3333','#990000','#660000'], N=10000000)
-			elif args.colors == 'green':
-				colormap_1 = LinearSegmentedColormap.from_list('colorbar', ['#CCFFCC','#66CC66','#339933','#006600','#003300'], N=10000000)
-			#norm = Normalize(vmin=min(df_rpkm),vmax=max(df_rpkm))
-			leg_color = plt.pcolor(df_rpkm, cmap=colormap_1)
-			plt.yticks(np.arange(0.2, len(df_rpkm.index), 1), df_rpkm.index)
-			plt.xticks(np.arange(0.2, len(df_rpkm.columns), 1), df_rpkm.columns)
-			plt.xticks(fontsize=1.5, rotation=90)
-			if args.phylo_colors:
-				ord_list = []
-				color_phy_list = []
-				phylo = open(args.phylo_colors, "r")
-				for lines in phylo.readlines():
-					line = lines.rstrip()
-					tabs = line.split("\t")
-					ids = tabs[0]
-					ord = tabs[1]
-					color = tabs[2]
-					ord_list.append(ord)
-					ord_list = [int(i) for i in ord_list]
-					color_phy_list.append(color)
-					color_phy_list = [str(i) for i in color_phy_list]
-#                    print(ord_list)
-#                    print(color_phy_list)
-				for val,val2 in zip(ord_list,color_phy_list):
-					plt.gca().get_xticklabels()[val].set_color(val2)
-			else:
-				pass
-			if args.xticks == 'off':
-				plt.xticks([])
-			else:
-				pass
-			if args.yticks == 'off':
-				plt.yticks([])
-			else:
-				pass
-			plt.yticks(fontsize=0.05)
-			plt.gca().invert_yaxis()
-			plt.gca().invert_yaxis()
-			plt.tight_layout()
-			legend = plt.colorbar(leg_color)
-			#plt.show()
-			date = time.strftime("%m.%d.%Y")
-			plt.savefig(args.o+"/"+project_name+'_rpkm_heat_'+date+'.png',dpi=900)
-		else:
-			colormap_1 = LinearSegmentedColormap.from_list('colorbar', ['#FFFF99','#efe350ff','#f7cb44ff','#f9b641ff','#f9a242ff',\
-			'#f68f46ff','#eb8055ff','#de7065ff','#cc6a70ff','#b8627dff','#a65c85ff','#90548bff','#7e4e90ff','#6b4596ff','#593d9cff',\
-			'#403891ff','#253582ff','#13306dff','#0c2a50ff','#042333ff'], N=10000000)
-			#norm = Normalize(vmin=min(df_rpkm),vmax=max(df_rpkm))
-			leg_color = plt.pcolor(df_rpkm, cmap=colormap_1)
-			plt.yticks(np.arange(0.2, len(df_rpkm.index), 1), df_rpkm.index)
-			plt.xticks(np.arange(0.2, len(df_rpkm.columns), 1), df_rpkm.columns)
-			plt.xticks(fontsize=1.5, rotation=90)
-			if args.phylo_colors:
-				ord_list = []
-				color_phy_list = []
-				phylo = open(args.phylo_colors, "r")
-				for lines in phylo.readlines():
-					line = lines.rstrip()
-					tabs = line.split("\t")
-					ids = tabs[0]
-					ord = tabs[1]
-					color = tabs[2]
-					ord_list.append(ord)
-					ord_list = [int(i) for i in ord_list]
-					color_phy_list.append(color)
-					color_phy_list = [str(i) for i in color_phy_list]
-#                    print(ord_list)
-#                    print(color_phy_list)
-				for val,val2 in zip(ord_list,color_phy_list):
-					plt.gca().get_yticklabels()[val].set_color(val2)
-			else:
-				pass
-			if args.xticks == 'off':
-				plt.xticks([])
-			else:
-				pass
-			if args.yticks == 'off':
-				plt.yticks([])
-			else:
-				pass
-			plt.yticks(fontsize=0.05)
-			plt.gca().invert_yaxis()
-			plt.tight_layout()
-			legend = plt.colorbar(leg_color)
-			#plt.show()
-			date = time.strftime("%m.%d.%Y")
-			plt.savefig(args.o+"/"+project_name+'_rpkm_heat_'+date+'.png',dpi=900)
-
-	elif args.sort_gen:
-		sorted_y = pd.read_csv(args.sort_gen, sep="\t")
-		print(sorted_y)
-		sorted_list_y = sorted_y.columns.tolist()
-		print(sorted_list_y)
-
-		df_rpkm = df_rpkm.reindex(sorted_list_y)
-#		df_rpkm = df_rpkm.T
-		df_rpkm = np.log10(df_rpkm)
-		df_rpkm[df_rpkm < 0] = 0
-		df_rpkm.to_csv(args.o+"/"+project_name+"_rpkm.csv", sep="\t")
-
-		#Heatmap sorted by Ocean and depth#
-		if args.colors:
-			if args.colors == 'plasma':
-				colormap_1 = LinearSegmentedColormap.from_list('colorbar', ['#FFFF99','#efe350ff','#f7cb44ff','#f9b641ff','#f9a242ff',\
-				'#f68f46ff','#eb8055ff','#de7065ff','#cc6a70ff','#b8627dff','#a65c85ff','#90548bff','#7e4e90ff','#6b4596ff','#593d9cff',\
-				'#403891ff','#253582ff','#13306dff','#0c2a50ff','#042333ff'], N=10000000)
-			elif args.colors == 'viridis':
-				colormap_1 = LinearSegmentedColormap.from_list('colorbar', ['#FFFF99','#DCE319FF','#B8DE29FF','#95D840FF','#73D055FF',\
-				'#55C667FF','#3CBB75FF','#29AF7FFF','#20A387FF','#1F968BFF','#238A8DFF','#287D8EFF','#2D708EFF','#33638DFF','#39568CFF',\
-				'#404788FF','#453781FF','#482677FF','#481567FF','#440154FF'], N=10000000)
-			elif args.colors == 'blue':
-				colormap_1 = LinearSegmentedColormap.from_list('colorbar', ['#99FFFF','#6699FF','#0000CC','#000099','#000066'], N=10000000)
-			elif args.colors == 'red':
-				colormap_1 = LinearSegmentedColormap.from_list('colorbar', ['#FFCCCC','#FF6666','#CC3333','#990000','#660000'], N=10000000)
-			elif args.colors == 'green':
-				colormap_1 = LinearSegmentedColormap.from_list('colorbar', ['#CCFFCC','#66CC66','#339933','#006600','#003300'], N=10000000)
-
-			leg_color = plt.pcolor(df_rpkm, cmap=colormap_1)
-			plt.yticks(np.arange(0.2, len(df_rpkm.index), 1), df_rpkm.index)
-			plt.xticks(np.arange(0.2, len(df_rpkm.columns), 1), df_rpkm.columns)
-			plt.xticks(fontsize=1.5, rotation=90)
-			if args.phylo_colors:
-				ord_list = []
-				color_phy_list = []
-				phylo = open(args.phylo_colors, "r")
-				for lines in phylo.readlines():
-					line = lines.rstrip()
-					tabs = line.split("\t")
-					ids = tabs[0]
-					ord = tabs[1]
-					color = tabs[2]
-					ord_list.append(ord)
-					ord_list = [int(i) for i in ord_list]
-					color_phy_list.append(color)
-					color_phy_list = [str(i) for i in color_phy_list]
-#                    print(ord_list)
-#                    print(color_phy_list)
-				for val,val2 in zip(ord_list,color_phy_list):
-					plt.gca().get_xticklabels()[val].set_color(val2)
-			else:
-				pass
-			if args.xticks == 'off':
-				plt.xticks([])
-			else:
-				pass
-			if args.yticks == 'off':
-				plt.yticks([])
-			else:
-				pass
-			plt.yticks(fontsize=0.05)
-			plt.gca().invert_yaxis()
-			plt.tight_layout()
-			legend = plt.colorbar(leg_color)
-			#plt.show()
-			date = time.strftime("%m.%d.%Y")
-			plt.savefig(args.o+"/"+project_name+'_rpkm_heat_'+date+'.png',dpi=900)
-		else:
-			colormap_1 = LinearSegmentedColormap.from_list('colorbar', ['#FFFF99','#efe350ff','#f7cb44ff','#f9b641ff','#f9a242ff',\
-			'#f68f46ff','#eb8055ff','#de7065ff','#cc6a70ff','#b8627dff','#a65c85ff','#90548bff','#7e4e90ff','#6b4596ff','#593d9cff',\
-			'#403891ff','#253582ff','#13306dff','#0c2a50ff','#042333ff'], N=10000000)
-			#norm = Normalize(vmin=min(df_rpkm),vmax=max(df_rpkm))
-			leg_color = plt.pcolor(df_rpkm, cmap=colormap_1)
-			plt.yticks(np.arange(0.2, len(df_rpkm.index), 1), df_rpkm.index)
-			plt.xticks(np.arange(0.2, len(df_rpkm.columns), 1), df_rpkm.columns)
-			plt.xticks(fontsize=1.5, rotation=90)
-			if args.phylo_colors:
-				ord_list = []
-				color_phy_list = []
-				phylo = open(args.phylo_colors, "r")
-				for lines in phylo.readlines():
-					line = lines.rstrip()
-					tabs = line.split("\t")
-					ids = tabs[0]
-					ord = tabs[1]
-					color = tabs[2]
-					ord_list.append(ord)
-					ord_list = [int(i) for i in ord_list]
-					color_phy_list.append(color)
-					color_phy_list = [str(i) for i in color_phy_list]
-#                    print(ord_list)
-#                    print(color_phy_list)
-				for val,val2 in zip(ord_list,color_phy_list):
-					plt.gca().get_xticklabels()[val].set_color(val2)
-			else:
-				pass
-			if args.xticks == 'off':
-				plt.xticks([])
-			else:
-				pass
-			if args.yticks == 'off':
-				plt.yticks([])
-			else:
-				pass
-			plt.yticks(fontsize=0.05)
-			plt.gca().invert_yaxis()
-			plt.tight_layout()
-			legend = plt.colorbar(leg_color)
-			#plt.show()
-			date = time.strftime("%m.%d.%Y")
-			plt.savefig(args.o+"/"+project_name+'_rpkm_heat_'+date+'.png',dpi=900)
-	else:
 
-		df_rpkm = np.log10(df_rpkm)
-		df_rpkm[df_rpkm < 0] = 0
-		df_rpkm.to_csv(args.o+"/"+project_name+"_rpkm.csv", sep="\t")
-
-		if args.colors:
-			if args.colors == 'plasma':
-				colormap_1 = LinearSegmentedColormap.from_list('colorbar', ['#FFFF99','#efe350ff','#f7cb44ff','#f9b641ff','#f9a242ff',\
-				'#f68f46ff','#eb8055ff','#de7065ff','#cc6a70ff','#b8627dff','#a65c85ff','#90548bff','#7e4e90ff','#6b4596ff','#593d9cff',\
-				'#403891ff','#253582ff','#13306dff','#0c2a50ff','#042333ff'], N=10000000)
-			elif args.colors == 'viridis':
-				colormap_1 = LinearSegmentedColormap.from_list('colorbar', ['#FFFF99','#DCE319FF','#B8DE29FF','#95D840FF','#73D055FF',\
-				'#55C667FF','#3CBB75FF','#29AF7FFF','#20A387FF','#1F968BFF','#238A8DFF','#287D8EFF','#2D708EFF','#33638DFF','#39568CFF',\
-				'#404788FF','#453781FF','#482677FF','#481567FF','#440154FF'], N=10000000)
-			elif args.colors == 'blue':
-				colormap_1 = LinearSegmentedColormap.from_list('colorbar', ['#99FFFF','#6699FF','#0000CC','#000099','#000066'], N=10000000)
-			elif args.colors == 'red':
-				colormap_1 = LinearSegmentedColormap.from_list('colorbar', ['#FFCCCC','#FF6666','#CC3333','#990000','#660000'], N=10000000)
-			elif args.colors == 'green':
-				colormap_1 = LinearSegmentedColormap.from_list('colorbar', ['#CCFFCC','#66CC66','#339933','#006600','#003300'], N=10000000)
-			#norm = Normalize(vmin=min(df_rpkm),vmax=max(df_rpkm))
-			leg_color = plt.pcolor(df_rpkm, cmap=colormap_1)
-			plt.yticks(np.arange(0.2, len(df_rpkm.index), 1), df_rpkm.index)
-			plt.xticks(np.arange(0.2, len(df_rpkm.columns), 1), df_rpkm.columns)
-			plt.xticks(fontsize=2, rotation=90)
-			if args.phylo_colors:
-				ord_list = []
-				color_phy_list = []
-				phylo = open(args.phylo_colors, "r")
-				for lines in phylo.readlines():
-					line = lines.rstrip()
-					tabs = line.split("\t")
-					ids = tabs[0]
-					ord = tabs[1]
-					color = tabs[2]
-					ord_list.append(ord)
-					ord_list = [int(i) for i in ord_list]
-					color_phy_list.append(color)
-					color_phy_list = [str(i) for i in color_phy_list]
-#                    print(ord_list)
-#                    print(color_phy_list)
-				for val,val2 in zip(ord_list,color_phy_list):
-					plt.gca().get_xticklabels()[val].set_color(val2)
-			else:
-				pass
-			if args.xticks == 'off':
-				plt.xticks([])
-			else:
-				pass
-			if args.yticks == 'off':
-				plt.yticks([])
-			else:
-				pass
-			plt.yticks(fontsize=2)
-			plt.gca().invert_yaxis()
-			plt.tight_layout()
-			legend = plt.colorbar(leg_color)
-			#plt.show()
-			date = time.strftime("%m.%d.%Y")
-			plt.savefig(args.o+"/"+project_name+'_rpkm_heat_'+date+'.png',dpi=900)
-		else:
-			colormap_1 = LinearSegmentedColormap.from_list('colorbar', ['#FFFF99','#efe350ff','#f7cb44ff','#f9b641ff','#f9a242ff',\
-			'#f68f46ff','#eb8055ff','#de7065ff','#cc6a70ff','#b8627dff','#a65c85ff','#90548bff','#7e4e90ff','#6b4596ff','#593d9cff',\
-			'#403891ff','#253582ff','#13306dff','#0c2a50ff','#042333ff'], N=10000000)
-			#norm = Normalize(vmin=min(df_rpkm),vmax=max(df_rpkm))
-			leg_color = plt.pcolor(df_rpkm, cmap=colormap_1)
-			plt.yticks(np.arange(0.2, len(df_rpkm.index), 1), df_rpkm.index)
-			plt.xticks(np.arange(0.2, len(df_rpkm.columns), 1), df_rpkm.columns)
-			plt.xticks(fontsize=1.5, rotation=90)
-			if args.phylo_colors:
-				ord_list = []
-				color_phy_list = []
-				phylo = open(args.phylo_colors, "r")
-				for lines in phylo.readlines():
-					line = lines.rstrip()
-					tabs = line.split("\t")
-					ids = tabs[0]
-					ord = tabs[1]
-					color = tabs[2]
-					ord_list.append(ord)
-					ord_list = [int(i) for i in ord_list]
-					color_phy_list.append(color)
-					color_phy_list = [str(i) for i in color_phy_list]
-#                    print(ord_list)
-#                    print(color_phy_list)
-				for val,val2 in zip(ord_list,color_phy_list):
-					plt.gca().get_xticklabels()[val].set_color(val2)
-			else:
-				pass
-			if args.xticks == 'off':
-				plt.xticks([])
-			else:
-				pass
-			if args.yticks == 'off':
-				plt.yticks([])
-			else:
-				pass
-			plt.yticks(fontsize=0.05)
-			plt.gca().invert_yaxis()
-			plt.tight_layout()
-			legend = plt.colorbar(leg_color)
-			#plt.show()
-			date = time.strftime("%m.%d.%Y")
-			plt.savefig(args.o+"/"+project_name+'_rpkm_heat_'+date+'.png',dpi=900)
+	sorted_list = read_sort_list(args.sort_samples) if args.sort_samples and args.sort_samples != 'auto' else None
+	sorted_list_y = read_sort_list(args.sort_gen) if args.sort_gen and args.sort_gen != 'auto' else None
+	with stage(profile, 'sort'):
+		if 'auto' in (args.sort_samples, args.sort_gen):
+			# genomes are clustered over the listed samples and samples over the listed genomes #
+			df_log = log_rpkm(sort_rpkm(df_rpkm, sorted_list, sorted_list_y))
+			linkage_file = None if args.no_cache else out_prefix+"_linkage.npz"
+			if args.sort_samples == 'auto':
+				sorted_list = auto_order(df_log, 1, linkage_file, method=args.linkage, optimal=args.olo)
+			if args.sort_gen == 'auto':
+				sorted_list_y = auto_order(df_log, 0, linkage_file, method=args.linkage, optimal=args.olo)
+			del df_log
+		selection = sort_positions(df_rpkm, sorted_list, sorted_list_y)
+	print(sorted_list)
+	print(sorted_list_y)
+	for line in selection['report']:
+		print("## "+line)
+
+	transform = args.transform or ('none' if args.count else 'log10')
+	groups = None
+	if args.group:
+		groups = read_groups(args.group, selection['col_labels'])
+		ungrouped = [sample for sample, group in zip(selection['col_labels'], groups) if group is None]
+		if ungrouped:
+			print("## -group leaves out "+str(len(ungrouped))+" samples: "+listed(ungrouped))
+		sizes = pd.Series([group for group in groups if group is not None]).value_counts(sort=False)
+		print("## groups: "+", ".join("%s (%d)" % (group, size) for group, size in sizes.items()))
+	if args.count and not (args.sort_samples or args.sort_gen or args.norm or args.transform or args.group or args.npy):
+		return
+
+	#Heatmap sorted by Ocean and depth#
+	date = time.strftime("%m.%d.%Y")
+	for norm in norms:
+		df_norm = df_rpkm if norm == norms[0] else norm_frame(norm)
+		with stage(profile, 'sort'):
+			df_norm = take_rpkm(df_norm, selection)
+		with stage(profile, 'normalize'):
+			outputs = [(norm, transform_matrix(df_norm, transform))]
+			if groups is not None:
+				# group summaries are taken on the untransformed values; prevalence (fraction of samples > 0) stays a fraction #
+				for stat in group_stats:
+					df_group = group_rpkm(df_norm, groups, stat)
+					outputs.append((norm+"_"+stat, df_group if stat == 'prevalence' else transform_matrix(df_group, transform)))
+		del df_norm
+		for name, df_out in outputs:
+			if args.count and args.sort_samples and args.sort_gen:
+				df_out = df_out.T
+			print(df_out)
+			with stage(profile, 'write'):
+				write_rpkm(df_out, out_prefix, npy=args.npy, name=name, npz=args.npz)
+			# with -group only the compact group heatmaps are drawn #
+			if args.count or (groups is not None and name == norm):
+				continue
+			if args.tiles:
+				tiles_dir = out_prefix+"_"+name+"_tiles"
+				with stage(profile, 'render'):
+					rendered = render_tiles(df_out, tiles_dir, colors=args.colors, jobs=args.jobs, title=project_name+" "+name)
+				print("## rendered "+str(rendered)+" tiles, open "+tiles_dir+"/index.html")
+				continue
+			with stage(profile, 'render'):
+				render_heatmap(df_out, out_prefix+'_'+name+'_heat_'+date+'.png', colors=args.colors, phylo_colors=phylo,
+					style={'xticks': args.xticks, 'yticks': args.yticks, 'dpi': args.dpi, 'renderer': args.renderer, 'phylo_strip': args.phylo_strip})
+
+if __name__ == '__main__':
+	main()